@@ -0,0 +1,339 @@
+"""
+对 `command.commands` 中的所有指令进行基准测试，使用合成图片，无需联网
+
+用法：
+    python benchmarks/benchmark.py [-k 关键词] [-r 重复次数] [-o 输出文件]
+    python benchmarks/benchmark.py -o new.json --compare old.json
+    python benchmarks/benchmark.py -k 模糊 -t 1 -o t1.json
+    python benchmarks/benchmark.py -k 模糊 -t 4 -o t4.json --compare t1.json
+    python benchmarks/benchmark.py -f webp -o webp.json --compare gif.json
+
+结果以 json 格式输出，可以用 `--compare` 与其他提交的结果对比，
+用 `-t` 指定并行处理的线程数，对比不同线程数的结果可以查看并行处理的扩展性，
+用 `-f` 指定动图的输出格式，对比不同格式的结果可以查看编码用时和输出大小
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import nonebot
+
+nonebot.init(driver="~none", log_level="WARNING")
+nonebot.load_plugin("nonebot_plugin_imagetools")
+
+import PIL
+from PIL import Image, ImageDraw
+from pil_utils import BuildImage
+
+from nonebot_plugin_imagetools.command import Command, commands
+from nonebot_plugin_imagetools.config import imagetools_config
+from nonebot_plugin_imagetools.job import new_job_stats
+
+TEXT_ARGS: dict[str, Any] = {
+    "旋转": 90,
+    "缩放": "50%",
+    "裁剪": "2:1",
+    "像素化": 8,
+    "颜色滤镜": "#66ccff",
+    "纯色图": "红色",
+    "渐变图": ["45", "红色", "黄色", "#66ccff"],
+    "gif变速": "2x",
+    "gif合成": 100,
+    "文字转图": "[b]简单图片操作[/b] [color=red]imagetools[/color] benchmark",
+}
+
+
+def make_static(size: tuple[int, int], fmt: str, transparent: bool = False) -> bytes:
+    mode = "RGBA" if transparent else "RGB"
+    image = Image.linear_gradient("L").resize(size).convert(mode)
+    draw = ImageDraw.Draw(image)
+    w, h = size
+    for i in range(8):
+        box = (w * i // 10, h * i // 12, w * (i + 2) // 10, h * (i + 3) // 12)
+        color = (255 - i * 30, i * 30, 128, 128 if transparent else 255)
+        draw.ellipse(box, fill=color)
+    output = BytesIO()
+    image.save(output, format=fmt)
+    return output.getvalue()
+
+
+def make_gif(size: tuple[int, int], n_frames: int, duration: int) -> bytes:
+    w, h = size
+    frames: list[Image.Image] = []
+    for i in range(n_frames):
+        frame = Image.new("RGB", size, (i * 7 % 256, 120, 200))
+        draw = ImageDraw.Draw(frame)
+        x = w * i // n_frames
+        draw.rectangle((x, h // 4, x + w // 5, h * 3 // 4), fill=(255, 220, 0))
+        draw.ellipse((w - x - w // 6, 0, w - x, h // 6), fill=(220, 0, 80))
+        frames.append(frame)
+    output = BytesIO()
+    frames[0].save(
+        output,
+        format="GIF",
+        save_all=True,
+        append_images=frames[1:],
+        duration=duration,
+        loop=0,
+    )
+    return output.getvalue()
+
+
+def make_corpus() -> tuple[dict[str, bytes], dict[str, list[bytes]]]:
+    singles = {
+        "small_jpg": make_static((400, 300), "JPEG"),
+        "large_jpg": make_static((4000, 3000), "JPEG"),
+        "small_png": make_static((400, 300), "PNG"),
+        "large_png": make_static((3000, 2000), "PNG"),
+        "huge_jpg": make_static((6000, 4000), "JPEG"),
+        "transparent_png": make_static((600, 600), "PNG", transparent=True),
+        "short_gif": make_gif((240, 240), 12, 80),
+        "long_gif": make_gif((480, 360), 150, 40),
+    }
+    sets = {
+        "static_set": [singles["small_jpg"], singles["small_png"]] * 2,
+        "mixed_set": [
+            singles["short_gif"],
+            singles["small_jpg"],
+            singles["transparent_png"],
+        ],
+        "gif_set": [singles["short_gif"], singles["long_gif"]],
+    }
+    return singles, sets
+
+
+def get_arg_names(command: Command) -> list[str]:
+    return [arg.name for arg in command.args.argument]
+
+
+class PeakRSS:
+    """在后台线程中采样当前进程的内存占用"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # 无法读取当前值时，退化为进程生命周期内的峰值
+            scale = 1 if sys.platform == "darwin" else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.base = self.current()
+        self.peak = self.base
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def output_nbytes(result: Any) -> int:
+    if isinstance(result, BytesIO):
+        return result.getbuffer().nbytes
+    if isinstance(result, list):
+        return sum(output_nbytes(r) for r in result)
+    return 0
+
+
+def run_case(
+    command: Command, make_args: Callable[[], dict[str, Any]], animated_format: str
+) -> dict:
+    args = make_args()
+    stats = new_job_stats(
+        parallel=command.parallel,
+        animated_format=animated_format,
+        scalable=command.scalable,
+    )
+    with PeakRSS() as rss:
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        result = command.func(**args)
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+    return {
+        "wall": wall,
+        "cpu": cpu,
+        "encode": stats.encode_time,
+        "peak_rss": rss.peak - rss.base,
+        "output_bytes": output_nbytes(result),
+        "encode_passes": stats.encode_passes,
+        "result": type(result).__name__,
+    }
+
+
+def iter_cases(
+    command: Command, singles: dict[str, bytes], sets: dict[str, list[bytes]]
+):
+    keyword = command.keywords[0]
+    names = get_arg_names(command)
+    text_args = {
+        name: TEXT_ARGS[keyword] for name in names if name in ("arg", "args", "num")
+    }
+    if "img" in names:
+        inputs = {name: [data] for name, data in singles.items()}
+    elif "imgs" in names:
+        inputs = sets
+    else:
+        inputs = {"text": []}
+
+    for input_name, datas in inputs.items():
+
+        def make_args(datas: list[bytes] = datas) -> dict[str, Any]:
+            args = dict(text_args)
+            images = [BuildImage.open(BytesIO(data)) for data in datas]
+            if "img" in names:
+                args["img"] = images[0]
+            elif "imgs" in names:
+                args["imgs"] = images
+            return args
+
+        yield input_name, make_args
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(keyword: Optional[str], repeat: int, animated_format: str) -> dict:
+    singles, sets = make_corpus()
+    records: list[dict] = []
+    for command in commands:
+        if keyword and keyword not in command.keywords:
+            continue
+        for input_name, make_args in iter_cases(command, singles, sets):
+            try:
+                runs = [
+                    run_case(command, make_args, animated_format) for _ in range(repeat)
+                ]
+            except Exception as e:
+                # 记录失败的用例，继续测试其他指令
+                records.append(
+                    {
+                        "command": command.keywords[0],
+                        "input": input_name,
+                        "error": repr(e),
+                    }
+                )
+                print(
+                    f"{command.keywords[0]:<8}\t{input_name:<16}\t{e!r}",
+                    file=sys.stderr,
+                )
+                continue
+            record = {
+                "command": command.keywords[0],
+                "input": input_name,
+                "wall": statistics.median(r["wall"] for r in runs),
+                "cpu": statistics.median(r["cpu"] for r in runs),
+                "encode": statistics.median(r["encode"] for r in runs),
+                "peak_rss": max(r["peak_rss"] for r in runs),
+                "output_bytes": runs[-1]["output_bytes"],
+                "encode_passes": runs[-1]["encode_passes"],
+                "result": runs[-1]["result"],
+            }
+            records.append(record)
+            print(
+                f"{record['command']:<8}\t{input_name:<16}\t"
+                f"wall {record['wall'] * 1000:8.1f} ms\t"
+                f"cpu {record['cpu'] * 1000:8.1f} ms\t"
+                f"encode {record['encode'] * 1000:8.1f} ms\t"
+                f"rss {record['peak_rss'] / 2**20:7.1f} MiB\t"
+                f"out {record['output_bytes'] / 1024:8.1f} KiB\t"
+                f"passes {record['encode_passes']}",
+                file=sys.stderr,
+            )
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "cpu_count": os.cpu_count(),
+        "repeat": repeat,
+        "threads": imagetools_config.imagetools_parallel_config.threads,
+        "animated_format": animated_format,
+        "records": records,
+    }
+
+
+def compare(result: dict, base: dict):
+    base_records = {(r["command"], r["input"]): r for r in base["records"]}
+    print(
+        f"compare {base.get('revision')} "
+        f"({base.get('threads')} threads, {base.get('animated_format')}) -> "
+        f"{result.get('revision')} "
+        f"({result.get('threads')} threads, {result.get('animated_format')})"
+    )
+    for record in result["records"]:
+        old = base_records.get((record["command"], record["input"]))
+        if old is None or "error" in record or "error" in old:
+            continue
+        ratios = [
+            f"{key} x{record[key] / old[key]:.2f}" if old.get(key) else f"{key} n/a"
+            for key in ("wall", "cpu", "encode", "output_bytes")
+        ]
+        print(f"{record['command']:<8}\t{record['input']:<16}\t" + "\t".join(ratios))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="imagetools benchmark")
+    parser.add_argument("-k", "--keyword", help="只测试指定的指令")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="每项重复次数")
+    parser.add_argument("-o", "--output", type=Path, help="结果输出文件")
+    parser.add_argument("--compare", type=Path, help="与之前的结果文件对比")
+    parser.add_argument("-t", "--threads", type=int, help="并行处理的线程数")
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=("gif", "webp", "apng"),
+        default="gif",
+        help="动图的输出格式",
+    )
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        imagetools_config.imagetools_parallel_config.threads = args.threads
+
+    result = run(args.keyword, args.repeat, args.format)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        args.output.write_text(text, encoding="utf-8")
+    else:
+        print(text)
+    if args.compare:
+        compare(result, json.loads(args.compare.read_text(encoding="utf-8")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+import hashlib
+import math
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable, Generic, Optional, TypeVar, Union
+
+from nonebot.log import logger
+from pil_utils import BuildImage
+
+from .config import imagetools_config
+from .metadata import get_image_bytes
+
+T = TypeVar("T")
+
+Result = Union[BytesIO, list[BytesIO]]
+CachedResult = Union[bytes, list[bytes]]
+
+
+def result_nbytes(value: CachedResult) -> int:
+    if isinstance(value, bytes):
+        return len(value)
+    return sum(len(v) for v in value)
+
+
+class LRUCache(Generic[T]):
+    """
+    带有大小限制和过期时间的内存LRU缓存
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        """
+        :params
+          * ``max_size``: 最大总大小，单位为字节
+          * ``ttl``: 过期时间，单位为秒
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self._items: OrderedDict[str, tuple[float, int, T]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[T]:
+        with self._lock:
+            if (item := self._items.get(key)) is None:
+                return None
+            expire_time, nbytes, value = item
+            if expire_time < time.monotonic():
+                del self._items[key]
+                self.size -= nbytes
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: T, nbytes: int):
+        if nbytes > self.max_size:
+            return
+        with self._lock:
+            if (item := self._items.pop(key, None)) is not None:
+                self.size -= item[1]
+            self._items[key] = (time.monotonic() + self.ttl, nbytes, value)
+            self.size += nbytes
+            while self.size > self.max_size:
+                _, (_, evicted_nbytes, _) = self._items.popitem(last=False)
+                self.size -= evicted_nbytes
+
+
+CACHE_MAGIC = b"IMTC\x01"
+"""磁盘缓存文件的文件头"""
+
+
+def pack_result(value: CachedResult) -> bytes:
+    """
+    将缓存结果打包为磁盘缓存文件的内容：文件头、是否为列表、图片数，之后为每张图片的长度和内容
+    """
+    values = [value] if isinstance(value, bytes) else value
+    parts = [CACHE_MAGIC, struct.pack("<?I", isinstance(value, list), len(values))]
+    for v in values:
+        parts.append(struct.pack("<Q", len(v)))
+        parts.append(v)
+    return b"".join(parts)
+
+
+def unpack_result(data: bytes) -> Optional[CachedResult]:
+    """解析磁盘缓存文件的内容，格式不正确时返回 ``None``"""
+    if not data.startswith(CACHE_MAGIC):
+        return None
+    offset = len(CACHE_MAGIC)
+    try:
+        is_list, count = struct.unpack_from("<?I", data, offset)
+        offset += struct.calcsize("<?I")
+        values: list[bytes] = []
+        for _ in range(count):
+            (length,) = struct.unpack_from("<Q", data, offset)
+            offset += 8
+            if offset + length > len(data):
+                return None
+            values.append(data[offset : offset + length])
+            offset += length
+    except struct.error:
+        return None
+    if offset != len(data) or (not is_list and count != 1):
+        return None
+    return values if is_list else values[0]
+
+
+class DiskCache:
+    """
+    带有大小限制和过期时间的磁盘缓存，按修改时间淘汰最久未使用的文件
+    """
+
+    def __init__(self, path: Path, max_size: int, ttl: float):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        path.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        file = self.path / key
+        try:
+            if file.stat().st_mtime + self.ttl < time.time():
+                file.unlink(missing_ok=True)
+                return None
+            if (value := unpack_result(file.read_bytes())) is None:
+                return None
+            os.utime(file)
+            return value
+        except OSError:
+            return None
+
+    def set(self, key: str, value: CachedResult):
+        if result_nbytes(value) > self.max_size:
+            return
+        file = self.path / key
+        tmp_file: Optional[Path] = None
+        try:
+            # 同一键可能同时写入，各自写入不同的临时文件后替换
+            fd, tmp_name = tempfile.mkstemp(
+                prefix=f"{key}.", suffix=".tmp", dir=self.path
+            )
+            tmp_file = Path(tmp_name)
+            with os.fdopen(fd, "wb") as f:
+                f.write(pack_result(value))
+            tmp_file.replace(file)
+        except OSError as e:
+            if tmp_file is not None:
+                tmp_file.unlink(missing_ok=True)
+            logger.warning(f"Failed to write imagetools cache: {e!r}")
+            return
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            now = time.time()
+            files: list[tuple[float, int, Path]] = []
+            total_size = 0
+            for file in self.path.iterdir():
+                # 跳过正在写入的临时文件
+                if file.suffix == ".tmp":
+                    continue
+                try:
+                    stat = file.stat()
+                except OSError:
+                    continue
+                if stat.st_mtime + self.ttl < now:
+                    file.unlink(missing_ok=True)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, file))
+                total_size += stat.st_size
+            files.sort()
+            for _, size, file in files:
+                if total_size <= self.max_size:
+                    break
+                file.unlink(missing_ok=True)
+                total_size -= size
+
+
+class ResultCache:
+    """
+    图片处理结果缓存，以输入图片内容、指令和参数为键
+    """
+
+    def __init__(self):
+        config = imagetools_config.imagetools_cache_config
+        self.memory: LRUCache[CachedResult] = LRUCache(
+            int(config.memory_max_size * 10**6), config.memory_ttl
+        )
+        self.disk: Optional[DiskCache] = None
+        if config.disk_dir:
+            self.disk = DiskCache(
+                Path(config.disk_dir),
+                int(config.disk_max_size * 10**6),
+                config.disk_ttl,
+            )
+
+    @staticmethod
+    def make_key(
+        keyword: str, args: dict[str, Any], animated_format: str = "gif"
+    ) -> Optional[str]:
+        """
+        根据指令、参数和动图的输出格式生成缓存键，图片以内容的哈希值表示
+        """
+        digest = hashlib.sha256(f"{keyword}\0{animated_format}".encode())
+        for key, value in sorted(args.items()):
+            values = value if isinstance(value, list) else [value]
+            digest.update(f"\0{key}".encode())
+            for v in values:
+                if isinstance(v, BuildImage):
+                    if (data := get_image_bytes(v.image)) is None:
+                        return None
+                    digest.update(hashlib.sha256(data).digest())
+                else:
+                    digest.update(f"\0{v!r}".encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Result]:
+        value = self.memory.get(key)
+        if value is None:
+            if not self.disk or (value := self.disk.get(key)) is None:
+                return None
+            self.memory.set(key, value, result_nbytes(value))
+        if isinstance(value, bytes):
+            return BytesIO(value)
+        return [BytesIO(v) for v in value]
+
+    def set(self, key: str, result: Any):
+        if isinstance(result, BytesIO):
+            value = result.getvalue()
+        elif isinstance(result, list) and all(isinstance(r, BytesIO) for r in result):
+            value = [r.getvalue() for r in result]
+        else:
+            return
+        self.memory.set(key, value, result_nbytes(value))
+        if self.disk:
+            self.disk.set(key, value)
+
+
+result_cache = ResultCache()
+
+
+generated_cache: LRUCache[bytes] = LRUCache(
+    int(imagetools_config.imagetools_cache_config.generated_max_size * 10**6),
+    math.inf,
+)
+
+ImageGenerator = Callable[..., BytesIO]
+
+
+def memoize_image(func: ImageGenerator) -> ImageGenerator:
+    """
+    缓存只依赖参数的图片生成函数的编码结果，参数需为规范化后的可哈希值
+    """
+
+    @wraps(func)
+    def wrapper(*args) -> BytesIO:
+        key = f"{func.__qualname__}{args!r}"
+        if (data := generated_cache.get(key)) is None:
+            data = func(*args).getvalue()
+            generated_cache.set(key, data, len(data))
+        return BytesIO(data)
+
+    return wrapper
@@ -0,0 +1,71 @@
+import re
+import string
+from functools import lru_cache
+from typing import Optional, Union
+
+from PIL import ImageColor
+from PIL.ImageColor import colormap
+
+from .color_table import color_table
+
+RGBColor = Union[tuple[int, int, int], tuple[int, int, int, int]]
+
+COLOR_HINT = (
+    "请使用正确的颜色格式，如：#66ccff、red、红色、102,204,255、hsl(200,100%,70%)"
+)
+
+num_256 = r"(25[0-5]|2[0-4][0-9]|[0-1]?[0-9]?[0-9])"
+color_pattern_num = re.compile(
+    rf"(?:rgb)?\(?\s*{num_256}[\s,]+{num_256}[\s,]+{num_256}\s*\)?;?"
+)
+num_percent = r"(100(?:\.0*)?|[0-9]?[0-9](?:\.[0-9]*)?)"
+color_pattern_hsl = re.compile(
+    rf"hsl\(\s*(\d+\.?\d*)\s*,\s*{num_percent}%\s*,\s*{num_percent}%\s*\)"
+)
+
+hex_digits = frozenset(string.hexdigits)
+
+# 颜色名称到颜色值的索引，css 颜色名称不区分大小写
+named_colors: dict[str, RGBColor] = {
+    **{name: ImageColor.getrgb(value) for name, value in colormap.items()},
+    **{name: ImageColor.getrgb(value) for name, value in color_table.items()},
+}
+
+
+def parse_hex(digits: str) -> Optional[RGBColor]:
+    """解析 ``#rgb``、``#rgba``、``#rrggbb``、``#rrggbbaa`` 格式的颜色"""
+    if len(digits) not in (3, 4, 6, 8) or not hex_digits.issuperset(digits):
+        return None
+    if len(digits) <= 4:
+        digits = "".join(c * 2 for c in digits)
+    channels = [int(digits[i : i + 2], 16) for i in range(0, len(digits), 2)]
+    if len(channels) == 3:
+        r, g, b = channels
+        return (r, g, b)
+    r, g, b, a = channels
+    return (r, g, b, a)
+
+
+@lru_cache(maxsize=1024)
+def parse_color(text: str) -> Optional[RGBColor]:
+    """
+    解析颜色，支持16进制颜色代码、颜色名称（英文或中文）、rgb 数值和 hsl 格式
+    :return
+      * 颜色值，无法解析时返回 ``None``
+    """
+    if (color := named_colors.get(text)) is not None:
+        return color
+    if text.startswith("#"):
+        return parse_hex(text[1:])
+    lower = text.lower()
+    if (color := named_colors.get(lower)) is not None:
+        return color
+    if lower.startswith("hsl"):
+        if color_pattern_hsl.fullmatch(lower):
+            r, g, b = ImageColor.getrgb(lower)[:3]
+            return (r, g, b)
+        return None
+    if match := color_pattern_num.fullmatch(text):
+        r, g, b = map(int, match.groups())
+        return (r, g, b)
+    return None
@@ -45,32 +45,57 @@ class Command:
     keywords: tuple[str, ...]
     args: Args
     func: Callable
+    parallel: bool = False
+    """
+    处理 gif 时是否可以在多个线程中同时处理不同帧，需要处理函数对各帧独立且线程安全
+    """
+    scalable: bool = False
+    """
+    处理结果是否与输入尺寸成比例，gif 需要缩小时先缩小输入帧再处理，
+    结果为固定尺寸（如裁剪、缩放）或按固定像素数处理（如像素化、滤镜）时不能启用
+    """
+    all_frames: bool = False
+    """
+    处理时是否同时保留输入 gif 的所有帧，调度时按所有帧预估内存占用
+    """
 
 
 commands = [
-    Command(("水平翻转", "左翻", "右翻"), arg_image, flip_horizontal),
-    Command(("竖直翻转", "上翻", "下翻"), arg_image, flip_vertical),
-    Command(("灰度图", "黑白"), arg_image, grey),
-    Command(("旋转",), arg_num_image, rotate),
-    Command(("缩放",), arg_text_image, resize),
-    Command(("裁剪",), arg_text_image, crop),
-    Command(("反相", "反色"), arg_image, invert),
-    Command(("轮廓",), arg_image, contour),
-    Command(("浮雕",), arg_image, emboss),
-    Command(("模糊",), arg_image, blur),
-    Command(("锐化",), arg_image, sharpen),
-    Command(("像素化",), arg_num_image, pixelate),
-    Command(("颜色滤镜",), arg_text_image, color_mask),
+    Command(
+        ("水平翻转", "左翻", "右翻"),
+        arg_image,
+        flip_horizontal,
+        parallel=True,
+        scalable=True,
+    ),
+    Command(
+        ("竖直翻转", "上翻", "下翻"),
+        arg_image,
+        flip_vertical,
+        parallel=True,
+        scalable=True,
+    ),
+    Command(("灰度图", "黑白"), arg_image, grey, parallel=True, scalable=True),
+    Command(("旋转",), arg_num_image, rotate, parallel=True, scalable=True),
+    Command(("缩放",), arg_text_image, resize, parallel=True),
+    Command(("裁剪",), arg_text_image, crop, parallel=True),
+    Command(("反相", "反色"), arg_image, invert, parallel=True, scalable=True),
+    Command(("轮廓",), arg_image, contour, parallel=True),
+    Command(("浮雕",), arg_image, emboss, parallel=True),
+    Command(("模糊",), arg_image, blur, parallel=True),
+    Command(("锐化",), arg_image, sharpen, parallel=True),
+    Command(("像素化",), arg_num_image, pixelate, parallel=True),
+    Command(("颜色滤镜",), arg_text_image, color_mask, parallel=True, scalable=True),
     Command(("纯色图",), arg_text, color_image),
     Command(("渐变图",), arg_texts, gradient_image),
     Command(("gif倒放", "倒放"), arg_image, gif_reverse),
     Command(("gif正放倒放", "正放倒放"), arg_image, gif_obverse_reverse),
     Command(("gif变速",), arg_text_image, gif_change_fps),
-    Command(("gif分解",), arg_image, gif_split),
+    Command(("gif分解",), arg_image, gif_split, all_frames=True),
     Command(("gif合成",), arg_num_images, gif_join),
     Command(("四宫格",), arg_image, four_grid),
     Command(("九宫格",), arg_image, nine_grid),
-    Command(("横向拼接",), arg_images, horizontal_join),
-    Command(("纵向拼接",), arg_images, vertical_join),
+    Command(("横向拼接",), arg_images, horizontal_join, scalable=True),
+    Command(("纵向拼接",), arg_images, vertical_join, scalable=True),
     Command(("文字转图",), arg_text, t2p),
 ]
@@ -1,6 +1,10 @@
+from typing import Literal, Optional
+
 from nonebot import get_plugin_config
 from pydantic import BaseModel
 
+from .worker import get_worker_config
+
 
 class MultipleImageConfig(BaseModel):
     send_one_by_one: bool = False
@@ -21,10 +25,190 @@ class MultipleImageConfig(BaseModel):
     """
 
 
+class FetchConfig(BaseModel):
+    concurrency: int = 4
+    """
+    单次指令中同时下载图片的最大数量
+    """
+    global_concurrency: int = 16
+    """
+    所有指令同时下载图片的最大数量
+    """
+
+
+class ImageLimitConfig(BaseModel):
+    max_image_pixels: int = 25_000_000
+    """
+    单帧像素数超出该值时，静图缩小后再处理，动图不予处理
+    """
+    max_total_pixels: int = 500_000_000
+    """
+    单帧像素数与帧数之积超出该值时，不予处理
+    """
+
+
+class ProcessPoolConfig(BaseModel):
+    workers: int = 0
+    """
+    进程池的进程数，默认为 `0`，即不启用进程池，在线程中处理图片
+    """
+    max_tasks_per_child: Optional[int] = 100
+    """
+    每个进程最多执行的任务数，超出后替换为新进程以释放内存，需要 Python 3.11 及以上
+    """
+    inline_max_pixels: int = 1_000_000
+    """
+    输入均为静图且像素数不超过该值时，直接在当前进程处理，避免进程间传输的开销
+    """
+
+
+class CacheConfig(BaseModel):
+    memory_max_size: float = 64
+    """
+    内存缓存的最大总大小，单位为 Mb，为 `0` 时不缓存
+    """
+    memory_ttl: float = 600
+    """
+    内存缓存的过期时间，单位为秒
+    """
+    disk_dir: Optional[str] = None
+    """
+    磁盘缓存的目录，默认为 `None`，即不启用磁盘缓存
+    """
+    disk_max_size: float = 512
+    """
+    磁盘缓存的最大总大小，单位为 Mb
+    """
+    disk_ttl: float = 86400
+    """
+    磁盘缓存的过期时间，单位为秒
+    """
+    generated_max_size: float = 16
+    """
+    纯色图、渐变图、文字转图等只依赖文字参数的结果的缓存大小，单位为 Mb，为 `0` 时不缓存
+    """
+
+
+class SchedulerConfig(BaseModel):
+    max_concurrency: int = 4
+    """
+    同时处理的最大任务数
+    """
+    memory_budget: float = 1024
+    """
+    同时处理的任务预估内存占用之和的上限，单位为 Mb，
+    按输入图片像素数与处理时保留在内存中的帧数之积估算
+    """
+    max_queue_size: int = 32
+    """
+    等待中的最大任务数，超出后直接拒绝新的任务
+    """
+    max_user_queue_size: int = 3
+    """
+    每个用户等待中的最大任务数
+    """
+    queued_notice: bool = True
+    """
+    任务需要排队时，是否提示用户
+    """
+
+
+class TimeoutConfig(BaseModel):
+    timeout: float = 60
+    """
+    单次指令的处理时间上限，单位为秒，为 `0` 时不限制
+    """
+    degraded_timeout: float = 30
+    """
+    超时后降低帧数和分辨率重新处理的时间上限，单位为秒，为 `0` 时不重新处理
+    """
+    degraded_max_frames: int = 30
+    """
+    降级处理时 gif 的最大帧数
+    """
+    degraded_scale: float = 0.5
+    """
+    降级处理时 gif 尺寸的最大缩放比例
+    """
+
+
+class MetricsConfig(BaseModel):
+    sinks: list[str] = ["histogram"]
+    """
+    指令执行指标的输出方式，可选 `histogram`、`logging`、`prometheus`
+    """
+    window: int = 1000
+    """
+    每个指令保留的最近执行记录数，用于计算分位数
+    """
+    prometheus_path: str = "/imagetools/metrics"
+    """
+    启用 `prometheus` 时，指标的 HTTP 访问路径，需要使用支持 HTTP 服务端的驱动器
+    """
+
+
+class ParallelConfig(BaseModel):
+    threads: int = 4
+    """
+    并行处理 gif 各帧或大图各区块的线程数，所有任务共用，为 `0` 时不并行处理
+    """
+    tile_min_pixels: int = 4_000_000
+    """
+    模糊、锐化、轮廓、浮雕等滤镜处理像素数不小于该值的图片时，将图片分块并行处理
+    """
+
+
+AnimatedFormat = Literal["gif", "webp", "apng"]
+
+
+class OutputConfig(BaseModel):
+    animated_format: AnimatedFormat = "gif"
+    """
+    动图的输出格式，可选 `gif`、`webp`、`apng`
+    """
+    adapter_formats: dict[str, AnimatedFormat] = {}
+    """
+    按适配器名称指定动图的输出格式，未指定的适配器使用 `animated_format`
+    """
+    webp_quality: int = 80
+    """
+    webp 的质量，范围为 0~100，无损压缩时表示压缩力度
+    """
+    webp_method: int = 4
+    """
+    webp 的编码方式，范围为 0~6，越大编码越慢、文件越小
+    """
+    webp_lossless: bool = False
+    """
+    webp 是否使用无损压缩
+    """
+    apng_compress_level: int = 6
+    """
+    apng 的压缩等级，范围为 0~9，越大编码越慢、文件越小
+    """
+    gif_global_palette: bool = True
+    """
+    gif 是否使用从采样帧生成的全局调色板，各帧并行量化；为 `False` 时每帧单独生成调色板
+    """
+
+
 class Config(BaseModel):
     imagetools_gif_max_size: float = 10
     imagetools_gif_max_frames: int = 100
     imagetools_multiple_image_config: MultipleImageConfig = MultipleImageConfig()
+    imagetools_fetch_config: FetchConfig = FetchConfig()
+    imagetools_image_limit_config: ImageLimitConfig = ImageLimitConfig()
+    imagetools_process_pool_config: ProcessPoolConfig = ProcessPoolConfig()
+    imagetools_cache_config: CacheConfig = CacheConfig()
+    imagetools_scheduler_config: SchedulerConfig = SchedulerConfig()
+    imagetools_timeout_config: TimeoutConfig = TimeoutConfig()
+    imagetools_metrics_config: MetricsConfig = MetricsConfig()
+    imagetools_parallel_config: ParallelConfig = ParallelConfig()
+    imagetools_output_config: OutputConfig = OutputConfig()
 
 
-imagetools_config = get_plugin_config(Config)
+if (worker_config := get_worker_config()) is not None:
+    # 进程池的子进程中没有初始化 nonebot，使用主进程传入的配置
+    imagetools_config = Config(**worker_config)
+else:
+    imagetools_config = get_plugin_config(Config)
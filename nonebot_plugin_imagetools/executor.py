@@ -0,0 +1,135 @@
+import asyncio
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Optional
+
+from nonebot import get_driver
+from nonebot.compat import model_dump
+from nonebot.log import logger
+from nonebot.utils import run_sync
+from nonebot_plugin_imagetools_worker import init_worker
+from pil_utils import BuildImage
+
+from .config import imagetools_config
+from .job import get_job_stats, merge_job_stats, remaining_time
+from .metadata import get_image_bytes
+from .parallel import shutdown_thread_pool
+from .worker import run_in_worker, warm_up
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _create_pool() -> ProcessPoolExecutor:
+    config = imagetools_config.imagetools_process_pool_config
+    kwargs: dict[str, Any] = {}
+    if sys.version_info >= (3, 11):
+        kwargs["max_tasks_per_child"] = config.max_tasks_per_child
+    # 子进程只导入图片处理模块，不初始化 nonebot、不加载插件，配置由主进程传入
+    # spawn 方式启动的子进程会导入入口文件，入口文件中初始化 nonebot 的代码需放在
+    # ``if __name__ == "__main__":`` 之下
+    return ProcessPoolExecutor(
+        config.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(model_dump(imagetools_config),),
+        **kwargs,
+    )
+
+
+def get_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    if imagetools_config.imagetools_process_pool_config.workers <= 0:
+        return None
+    if _pool is None:
+        _pool = _create_pool()
+    return _pool
+
+
+driver = get_driver()
+
+
+@driver.on_startup
+async def _():
+    if pool := get_pool():
+        workers = imagetools_config.imagetools_process_pool_config.workers
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *(loop.run_in_executor(pool, warm_up) for _ in range(workers)),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.warning(f"Failed to warm up imagetools worker: {result!r}")
+        logger.info(f"imagetools process pool started with {workers} workers")
+
+
+@driver.on_shutdown
+async def _():
+    global _pool
+    shutdown_thread_pool()
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _encode_arg(value: Any) -> Any:
+    if isinstance(value, BuildImage):
+        return get_image_bytes(value.image)
+    if isinstance(value, list):
+        return [_encode_arg(v) for v in value]
+    return value
+
+
+def should_offload(args: dict[str, Any]) -> bool:
+    """
+    输入均为较小的静图时，直接在当前进程处理，避免进程间传输的开销
+    """
+    config = imagetools_config.imagetools_process_pool_config
+    images: list[BuildImage] = []
+    if img := args.get("img"):
+        images.append(img)
+    if imgs := args.get("imgs"):
+        images.extend(imgs)
+    for img in images:
+        if get_image_bytes(img.image) is None:
+            return False
+    return any(
+        getattr(img.image, "is_animated", False)
+        or img.width * img.height > config.inline_max_pixels
+        for img in images
+    )
+
+
+async def run_func(func: Callable, args: dict[str, Any]) -> Any:
+    """
+    执行图片处理函数，启用进程池时较大的任务在子进程中执行，否则在线程中执行
+    协程被取消时，线程中的处理函数在下一次检查时停止，子进程中的任务则继续执行至超时
+    :params
+      * ``func``: 图片处理函数
+      * ``args``: 参数，图片以 ``BuildImage`` 形式传入
+    """
+    stats = get_job_stats()
+    pool = get_pool()
+    try:
+        if pool is None or not should_offload(args):
+            return await run_sync(func)(**args)
+
+        encoded_args = {key: _encode_arg(value) for key, value in args.items()}
+        loop = asyncio.get_running_loop()
+        result, worker_stats = await loop.run_in_executor(
+            pool,
+            run_in_worker,
+            func,
+            encoded_args,
+            remaining_time(stats),
+            stats.degraded,
+            stats.parallel,
+            stats.animated_format,
+            stats.scalable,
+        )
+        merge_job_stats(stats, worker_stats)
+        return result
+    except asyncio.CancelledError:
+        stats.cancelled = True
+        raise
@@ -3,30 +3,41 @@ import re
 from io import BytesIO
 from typing import Optional
 
-from PIL import ImageFilter, ImageOps
+from PIL import Image, ImageFilter, ImageOps
+from PIL.Image import Image as IMG
 from PIL.Image import Transpose
-from PIL.ImageColor import colormap
 from pil_utils import BuildImage, Text2Image
 from pil_utils.gradient import ColorStop, LinearGradient
-from pil_utils.typing import ColorType
 
-from .color_table import color_table
-from .utils import Maker, get_avg_duration, make_png_or_gif, save_gif, split_gif
-
-colors = "|".join(colormap.keys())
-color_pattern_str = rf"#[a-fA-F0-9]{{6}}|{colors}"
-
-num_256 = r"(25[0-5]|2[0-4][0-9]|[0-1]?[0-9]?[0-9])"
-color_pattern_num = rf"(?:rgb)?\(?\s*{num_256}[\s,]+{num_256}[\s,]+{num_256}\s*\)?;?"
+from .cache import memoize_image
+from .color import COLOR_HINT, RGBColor, parse_color
+from .gif_stream import remux_gif, transform_gif
+from .job import get_job_stats
+from .metadata import get_image_bytes
+from .utils import (
+    Maker,
+    draft_image,
+    filter_image,
+    get_avg_duration,
+    get_n_frames,
+    make_png_or_gif,
+    save_gif,
+    save_gif_frames,
+    split_gif,
+)
 
 
 def flip_horizontal(img: BuildImage):
+    if output := transform_gif_frames(img, Transpose.FLIP_LEFT_RIGHT):
+        return output
     return make_png_or_gif(
         [img], lambda imgs: imgs[0].transpose(Transpose.FLIP_LEFT_RIGHT)
     )
 
 
 def flip_vertical(img: BuildImage):
+    if output := transform_gif_frames(img, Transpose.FLIP_TOP_BOTTOM):
+        return output
     return make_png_or_gif(
         [img], lambda imgs: imgs[0].transpose(Transpose.FLIP_TOP_BOTTOM)
     )
@@ -36,8 +47,21 @@ def grey(img: BuildImage):
     return make_png_or_gif([img], lambda imgs: imgs[0].convert("L"))
 
 
+ROTATE_TRANSPOSES = {
+    90: Transpose.ROTATE_90,
+    180: Transpose.ROTATE_180,
+    270: Transpose.ROTATE_270,
+}
+"""逆时针旋转角度对应的变换方式"""
+
+
 def rotate(num: Optional[int], img: BuildImage):
     angle = num or 90
+    # 旋转 90 度的整数倍时只移动像素，旋转 0 度时不变换
+    if angle % 90 == 0 and (
+        output := transform_gif_frames(img, ROTATE_TRANSPOSES.get(angle % 360))
+    ):
+        return output
     return make_png_or_gif([img], lambda imgs: imgs[0].rotate(angle, expand=True))
 
 
@@ -46,20 +70,26 @@ def resize(arg: str, img: BuildImage):
     match1 = re.fullmatch(r"(\d{1,4})?[*xX, ](\d{1,4})?", arg)
     match2 = re.fullmatch(r"(\d{1,3})%", arg)
     make: Optional[Maker] = None
+    size = (w, h)
     if match1:
         w = match1.group(1)
         h = match1.group(2)
         if not w and h:
             make = lambda imgs: imgs[0].resize_height(int(h))
+            size = (img.width * int(h) // img.height, int(h))
         elif w and not h:
             make = lambda imgs: imgs[0].resize_width(int(w))
+            size = (int(w), img.height * int(w) // img.width)
         elif w and h:
             make = lambda imgs: imgs[0].resize((int(w), int(h)))
+            size = (int(w), int(h))
     elif match2:
         ratio = int(match2.group(1)) / 100
         make = lambda imgs: imgs[0].resize((int(w * ratio), int(h * ratio)))
+        size = (int(w * ratio), int(h * ratio))
     if not make:
         return "请使用正确的尺寸格式，如：100x100、100x、50%"
+    draft_image(img, size)
     return make_png_or_gif([img], make)
 
 
@@ -69,16 +99,19 @@ def crop(arg: str, img: BuildImage):
     match2 = re.fullmatch(r"(\d{1,2})[:：比](\d{1,2})", arg)
     make: Optional[Maker] = None
     if match1:
-        w = int(match1.group(1))
-        h = int(match1.group(2))
-        make = lambda imgs: imgs[0].resize_canvas((w, h), bg_color="white")
+        canvas_size = (int(match1.group(1)), int(match1.group(2)))
+        make = lambda imgs: imgs[0].resize_canvas(canvas_size, bg_color="white")
     elif match2:
         wp = int(match2.group(1))
         hp = int(match2.group(2))
         size = min(w / wp, h / hp)
-        make = lambda imgs: imgs[0].resize_canvas((int(wp * size), int(hp * size)))
+        canvas_size = (int(wp * size), int(hp * size))
+        make = lambda imgs: imgs[0].resize_canvas(canvas_size)
     if not make:
         return "请使用正确的裁剪格式，如：100x100、2:1"
+    # 裁剪后的尺寸不超过原图时只需要裁剪，超出时需要填充背景色
+    if output := transform_gif_frames(img, box=canvas_box(img.size, canvas_size)):
+        return output
     return make_png_or_gif([img], make)
 
 
@@ -93,58 +126,63 @@ def invert(img: BuildImage):
 
 
 def contour(img: BuildImage):
-    return make_png_or_gif([img], lambda imgs: imgs[0].filter(ImageFilter.CONTOUR))
+    return make_png_or_gif(
+        [img], lambda imgs: filter_image(imgs[0], ImageFilter.CONTOUR)
+    )
 
 
 def emboss(img: BuildImage):
-    return make_png_or_gif([img], lambda imgs: imgs[0].filter(ImageFilter.EMBOSS))
+    return make_png_or_gif(
+        [img], lambda imgs: filter_image(imgs[0], ImageFilter.EMBOSS)
+    )
 
 
 def blur(img: BuildImage):
-    return make_png_or_gif([img], lambda imgs: imgs[0].filter(ImageFilter.BLUR))
+    return make_png_or_gif([img], lambda imgs: filter_image(imgs[0], ImageFilter.BLUR))
 
 
 def sharpen(img: BuildImage):
-    return make_png_or_gif([img], lambda imgs: imgs[0].filter(ImageFilter.SHARPEN))
+    return make_png_or_gif(
+        [img], lambda imgs: filter_image(imgs[0], ImageFilter.SHARPEN)
+    )
 
 
 def pixelate(num: Optional[int], img: BuildImage):
     num = num or 8
+    size: Optional[tuple[int, int]] = None
+    if not getattr(img.image, "is_animated", False):
+        # jpeg 图片以缩小的比例解码，像素块大小仍按原尺寸计算
+        size = img.size
+        draft_image(img, (img.width // num, img.height // num))
 
     def make(imgs: list[BuildImage]) -> BuildImage:
         img = imgs[0]
-        image = img.image
-        image = image.resize((img.width // num, img.height // num), resample=0)
-        image = image.resize(img.size, resample=0)
+        w, h = size or img.size
+        image = img.image.resize((w // num, h // num), resample=0)
+        image = image.resize((w, h), resample=0)
         return BuildImage(image)
 
     return make_png_or_gif([img], make)
 
 
 def color_mask(arg: str, img: BuildImage):
-    if re.fullmatch(color_pattern_str, arg):
-        color = arg
-    elif match := re.fullmatch(color_pattern_num, arg):
-        color = tuple(map(int, match.groups()))
-        assert len(color) == 3
-    elif arg in color_table:
-        color = color_table[arg]
-    else:
-        return "请使用正确的颜色格式，如：#66ccff、red、红色、102,204,255"
-    return make_png_or_gif([img], lambda imgs: imgs[0].color_mask(color))
+    if (color := parse_color(arg)) is None:
+        return COLOR_HINT
+    # 滤镜只使用颜色的 rgb 分量
+    r, g, b = color[:3]
+    return make_png_or_gif([img], lambda imgs: imgs[0].color_mask((r, g, b)))
 
 
 def color_image(arg: str):
-    if re.fullmatch(color_pattern_str, arg):
-        color = arg
-    elif match := re.fullmatch(color_pattern_num, arg):
-        color = tuple(map(int, match.groups()))
-        assert len(color) == 3
-    elif arg in color_table:
-        color = color_table[arg]
-    else:
-        return "请使用正确的颜色格式，如：#66ccff、red、红色、102,204,255"
-    return BuildImage.new("RGB", (500, 500), color).save_png()
+    if (color := parse_color(arg)) is None:
+        return COLOR_HINT
+    return render_color_image(color)
+
+
+@memoize_image
+def render_color_image(color: RGBColor) -> BytesIO:
+    mode = "RGBA" if len(color) == 4 else "RGB"
+    return BuildImage.new(mode, (500, 500), color).save_png()
 
 
 def gradient_image(args: list[str]):
@@ -163,28 +201,52 @@ def gradient_image(args: list[str]):
     if not args:
         return
 
-    colors: list[ColorType] = []
+    colors: list[RGBColor] = []
     for arg in args:
-        if re.fullmatch(color_pattern_str, arg):
-            color = arg
-        elif match := re.fullmatch(color_pattern_num, arg):
-            color = tuple(map(int, match.groups()))
-            assert len(color) == 3
-        elif arg in color_table:
-            color = color_table[arg]
-        else:
-            return "请使用正确的颜色格式，如：#66ccff、red、红色、102,204,255"
+        if (color := parse_color(arg)) is None:
+            return COLOR_HINT
         colors.append(color)
 
+    return render_gradient_image(angle, tuple(colors))
+
+
+def two_color_gradient(
+    size: tuple[int, int], colors: tuple[RGBColor, ...], vertical: bool
+) -> IMG:
+    """
+    水平或竖直方向的双色渐变，只计算一行或一列像素后拉伸，结果与 skia 绘制的一致
+    """
+    w, h = size
+    n = h if vertical else w
+    c0, c1 = ((*color[:3], 255) for color in colors)
+    line = Image.new("RGBA", (1, n) if vertical else (n, 1))
+    line.putdata(
+        [
+            # 与 skia 一致，四舍五入而非银行家舍入
+            tuple(int(a + (b - a) * (i + 0.5) / n + 0.5) for a, b in zip(c0, c1))
+            for i in range(n)
+        ]
+    )
+    return line.resize(size, Image.Resampling.NEAREST)
+
+
+@memoize_image
+def render_gradient_image(angle: int, colors: tuple[RGBColor, ...]) -> BytesIO:
     img_w = 500
     img_h = 500
-    angle *= math.pi / 180
-    if math.sqrt(img_w**2 + img_h**2) * math.cos(angle) <= img_w:
+    # 带透明度时 skia 的结果有舍入差异，只处理不透明的颜色
+    opaque = all(len(color) == 3 or color[3] == 255 for color in colors)
+    if len(colors) == 2 and angle in (0, 90) and opaque:
+        img = two_color_gradient((img_w, img_h), colors, vertical=angle == 90)
+        return BuildImage(img).save_png()
+
+    radian = angle * math.pi / 180
+    if math.sqrt(img_w**2 + img_h**2) * math.cos(radian) <= img_w:
         dy = img_h / 2
-        dx = dy / math.tan(angle)
+        dx = dy / math.tan(radian)
     else:
         dx = img_w / 2
-        dy = dx * math.tan(angle)
+        dy = dx * math.tan(radian)
 
     gradient = LinearGradient(
         (img_w / 2 - dx, img_h / 2 - dy, img_w / 2 + dx, img_h / 2 + dy),
@@ -194,23 +256,65 @@ def gradient_image(args: list[str]):
     return BuildImage(img).save_png()
 
 
+def get_gif_bytes(image: IMG) -> Optional[bytes]:
+    """输出格式为 gif 时，获取可以直接在码流层面重排的输入 gif 字节"""
+    if get_job_stats().animated_format != "gif":
+        return None
+    return get_image_bytes(image)
+
+
+def transform_gif_frames(
+    img: BuildImage,
+    method: Optional[Transpose] = None,
+    box: Optional[tuple[int, int, int, int]] = None,
+) -> Optional[BytesIO]:
+    """
+    输出 gif 且只需要移动像素时，直接变换各帧的调色板图像，不合成画面、不重新量化
+    :params
+      * ``method``: 可选，翻转或旋转方式
+      * ``box``: 可选，裁剪的区域
+    """
+    image = img.image
+    if not getattr(image, "is_animated", False) or not (data := get_gif_bytes(image)):
+        return None
+    return transform_gif(data, method, box)
+
+
+def canvas_box(
+    size: tuple[int, int], canvas_size: tuple[int, int]
+) -> tuple[int, int, int, int]:
+    """居中调整画布大小时原图中保留的区域，与 ``BuildImage.resize_canvas`` 一致"""
+    w, h = canvas_size
+    x = -int((w - size[0]) / 2)
+    y = -int((h - size[1]) / 2)
+    return (x, y, x + w, y + h)
+
+
 def gif_reverse(img: BuildImage):
     image = img.image
     if not getattr(image, "is_animated", False):
         return "请发送 gif 格式的图片"
-    frames = split_gif(image)
     duration = get_avg_duration(image)
-    return save_gif(frames[::-1], duration)
+    n_frames = get_n_frames(image)
+    if (data := get_gif_bytes(image)) and (
+        output := remux_gif(data, list(range(n_frames))[::-1], duration)
+    ):
+        return output
+    return save_gif_frames(image, list(range(n_frames))[::-1], duration)
 
 
 def gif_obverse_reverse(img: BuildImage):
     image = img.image
     if not getattr(image, "is_animated", False):
         return "请发送 gif 格式的图片"
-    frames = split_gif(image)
     duration = get_avg_duration(image)
-    frames = frames + frames[-2::-1]
-    return save_gif(frames, duration)
+    n_frames = get_n_frames(image)
+    order = list(range(n_frames))
+    if (data := get_gif_bytes(image)) and (
+        output := remux_gif(data, order + order[-2::-1], duration)
+    ):
+        return output
+    return save_gif_frames(image, order + order[-2::-1], duration)
 
 
 def gif_change_fps(arg: str, img: BuildImage):
@@ -237,8 +341,12 @@ def gif_change_fps(arg: str, img: BuildImage):
             f"超过该限制可能会导致 GIF 显示速度不正常。\n"
             f"当前帧间隔为 {duration:.3f} s ({1 / duration:.1f} FPS)"
         )
-    frames = split_gif(image)
-    return save_gif(frames, duration)
+    n_frames = get_n_frames(image)
+    if (data := get_gif_bytes(image)) and (
+        output := remux_gif(data, list(range(n_frames)), duration)
+    ):
+        return output
+    return save_gif_frames(image, list(range(n_frames)), duration)
 
 
 def gif_split(img: BuildImage):
@@ -300,39 +408,72 @@ def horizontal_join(imgs: list[BuildImage]):
     if len(imgs) < 2:
         return "图片拼接至少需要2张图片"
 
-    def make(imgs: list[BuildImage]) -> BuildImage:
+    def prepare(imgs: list[BuildImage], animated: list[bool]) -> Maker:
         img_h = min([img.height for img in imgs])
-        imgs = [img.resize((img.width * img_h // img.height, img_h)) for img in imgs]
-        img_w = sum([img.width for img in imgs])
-        frame = BuildImage.new("RGB", (img_w, img_h), "white")
+        sizes = [(img.width * img_h // img.height, img_h) for img in imgs]
+        img_w = sum([w for w, _ in sizes])
+        positions: list[tuple[int, int]] = []
         x = 0
-        for img in imgs:
-            frame.paste(img, (x, 0))
-            x += img.width
-        return frame
+        for w, _ in sizes:
+            positions.append((x, 0))
+            x += w
+
+        # 静图只缩放和粘贴一次
+        background = BuildImage.new("RGB", (img_w, img_h), "white")
+        for img, size, pos, is_animated in zip(imgs, sizes, positions, animated):
+            if not is_animated:
+                background.paste(img.resize(size), pos)
 
-    return make_png_or_gif(imgs, make)
+        def make(imgs: list[BuildImage]) -> BuildImage:
+            frame = background.copy()
+            for img, size, pos, is_animated in zip(imgs, sizes, positions, animated):
+                if is_animated:
+                    frame.paste(img.resize(size), pos)
+            return frame
+
+        return make
+
+    return make_png_or_gif(imgs, prepare=prepare)
 
 
 def vertical_join(imgs: list[BuildImage]):
     if len(imgs) < 2:
         return "图片拼接至少需要2张图片"
 
-    def make(imgs: list[BuildImage]) -> BuildImage:
+    def prepare(imgs: list[BuildImage], animated: list[bool]) -> Maker:
         img_w = min([img.width for img in imgs])
-        imgs = [img.resize((img_w, img.height * img_w // img.width)) for img in imgs]
-        img_h = sum([img.height for img in imgs])
-        frame = BuildImage.new("RGB", (img_w, img_h), "white")
+        sizes = [(img_w, img.height * img_w // img.width) for img in imgs]
+        img_h = sum([h for _, h in sizes])
+        positions: list[tuple[int, int]] = []
         y = 0
-        for img in imgs:
-            frame.paste(img, (0, y))
-            y += img.height
-        return frame
+        for _, h in sizes:
+            positions.append((0, y))
+            y += h
+
+        # 静图只缩放和粘贴一次
+        background = BuildImage.new("RGB", (img_w, img_h), "white")
+        for img, size, pos, is_animated in zip(imgs, sizes, positions, animated):
+            if not is_animated:
+                background.paste(img.resize(size), pos)
 
-    return make_png_or_gif(imgs, make)
+        def make(imgs: list[BuildImage]) -> BuildImage:
+            frame = background.copy()
+            for img, size, pos, is_animated in zip(imgs, sizes, positions, animated):
+                if is_animated:
+                    frame.paste(img.resize(size), pos)
+            return frame
+
+        return make
+
+    return make_png_or_gif(imgs, prepare=prepare)
 
 
 def t2p(arg: str):
+    return render_text_image(arg)
+
+
+@memoize_image
+def render_text_image(arg: str) -> BytesIO:
     text2img = Text2Image.from_bbcode_text(arg, 30)
     max_width = min(math.ceil(text2img.longest_line), 1000)
     img = text2img.to_image(max_width, bg_color="white", padding=(20, 20))
@@ -0,0 +1,390 @@
+import struct
+from dataclasses import dataclass
+from io import BytesIO
+from typing import BinaryIO, Optional
+
+from PIL import Image
+from PIL.Image import Image as IMG
+from PIL.Image import Transpose
+
+from .config import imagetools_config
+from .job import check_deadline
+
+NETSCAPE_LOOP = b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00"
+"""无限循环的 NETSCAPE 应用扩展块"""
+
+
+@dataclass
+class GifFrame:
+    left: int
+    top: int
+    width: int
+    height: int
+    delay: Optional[int]
+    """帧间隔，单位为 1/100 秒，没有图形控制扩展时为 ``None``"""
+    disposal: int
+    """处置方式，0、1 为保留，2 为恢复背景，3 为恢复上一帧"""
+    transparency: Optional[int]
+    """透明色索引"""
+    data: bytes
+    """图像描述符、局部颜色表和图像数据的原始字节"""
+
+
+@dataclass
+class GifStream:
+    width: int
+    height: int
+    header: bytes
+    """文件头、逻辑屏幕描述符和全局颜色表的原始字节"""
+    frames: list[GifFrame]
+
+
+def _skip_sub_blocks(data: bytes, pos: int) -> int:
+    while True:
+        size = data[pos]
+        pos += 1
+        if size == 0:
+            return pos
+        pos += size
+
+
+def parse_gif(data: bytes) -> GifStream:
+    """
+    解析 gif 码流的块结构，不解码图像数据
+    """
+    if len(data) < 13 or data[:6] not in (b"GIF87a", b"GIF89a"):
+        raise ValueError("not a gif file")
+    width, height, flags = struct.unpack_from("<HHB", data, 6)
+    pos = 13
+    if flags & 0x80:
+        pos += 3 << ((flags & 0x07) + 1)
+    header = data[:pos]
+
+    frames: list[GifFrame] = []
+    delay: Optional[int] = None
+    disposal = 0
+    transparency: Optional[int] = None
+    try:
+        while True:
+            block = data[pos]
+            if block == 0x3B:
+                break
+            elif block == 0x21:
+                label = data[pos + 1]
+                if label == 0xF9:
+                    flags, delay, index = struct.unpack_from("<BHB", data, pos + 3)
+                    disposal = (flags >> 2) & 0x07
+                    transparency = index if flags & 0x01 else None
+                pos = _skip_sub_blocks(data, pos + 2)
+            elif block == 0x2C:
+                start = pos
+                left, top, w, h, flags = struct.unpack_from("<HHHHB", data, pos + 1)
+                pos += 10
+                if flags & 0x80:
+                    pos += 3 << ((flags & 0x07) + 1)
+                pos = _skip_sub_blocks(data, pos + 1)
+                frames.append(
+                    GifFrame(
+                        left, top, w, h, delay, disposal, transparency, data[start:pos]
+                    )
+                )
+                delay = None
+                disposal = 0
+                transparency = None
+            else:
+                raise ValueError(f"unknown block type: {block:#x}")
+    except (IndexError, struct.error):
+        # 文件被截断时，保留已完整读取的帧
+        if not frames:
+            raise ValueError("truncated gif file")
+    return GifStream(width, height, header, frames)
+
+
+def is_self_contained(stream: GifStream) -> bool:
+    """
+    判断每一帧是否都不依赖之前的画面，即可以任意重排帧的顺序
+    """
+    full_rect = (0, 0, stream.width, stream.height)
+    for frame in stream.frames:
+        if (frame.left, frame.top, frame.width, frame.height) != full_rect:
+            return False
+    if any(frame.transparency is not None for frame in stream.frames):
+        # 有透明色时，只有每帧都恢复背景才不会透出上一帧
+        return all(frame.disposal == 2 for frame in stream.frames)
+    return True
+
+
+def graphic_control_extension(
+    delay: int, disposal: int, transparency: Optional[int]
+) -> bytes:
+    flags = (disposal & 0x07) << 2
+    index = 0
+    if transparency is not None:
+        flags |= 0x01
+        index = transparency
+    return struct.pack("<BBBBHBB", 0x21, 0xF9, 4, flags, delay, index, 0)
+
+
+def logical_screen(
+    width: int, height: int, color_table: bytes = b"", background: int = 0
+) -> bytes:
+    """
+    文件头和逻辑屏幕描述符
+    :params
+      * ``color_table``: 可选，全局颜色表，颜色数需要为 2 的幂
+      * ``background``: 背景色在全局颜色表中的索引
+    """
+    flags = 0
+    if color_table:
+        # 颜色表大小为 2 ** (n + 1)
+        flags = 0xF0 | ((len(color_table) // 3).bit_length() - 2)
+    return (
+        b"GIF89a"
+        + struct.pack("<HHBBB", width, height, flags, background, 0)
+        + color_table
+    )
+
+
+def write_gif(stream: GifStream, frames: list[GifFrame], delays: list[int]) -> BytesIO:
+    output = BytesIO()
+    output.write(b"GIF89a")
+    output.write(stream.header[6:])
+    output.write(NETSCAPE_LOOP)
+    for frame, delay in zip(frames, delays):
+        output.write(
+            graphic_control_extension(delay, frame.disposal, frame.transparency)
+        )
+        output.write(frame.data)
+    output.write(b"\x3b")
+    return output
+
+
+def remux_gif(data: bytes, order: list[int], duration: float) -> Optional[BytesIO]:
+    """
+    不解码图像数据，直接在码流层面重排gif帧并重写帧间隔
+    :params
+      * ``data``: gif文件字节
+      * ``order``: 输出的帧索引列表
+      * ``duration``: 输出的帧间隔，单位为秒
+    :return
+      * 帧依赖之前的画面导致无法重排、或结果超出大小限制时返回 ``None``
+    """
+    try:
+        stream = parse_gif(data)
+    except ValueError:
+        return None
+
+    n_frames = len(stream.frames)
+    if any(i >= n_frames for i in order):
+        return None
+    if order != list(range(n_frames)) and not is_self_contained(stream):
+        return None
+
+    delay = round(duration * 100)
+    output = write_gif(stream, [stream.frames[i] for i in order], [delay] * len(order))
+    if output.getbuffer().nbytes > imagetools_config.imagetools_gif_max_size * 10**6:
+        return None
+    return output
+
+
+class GifWriter:
+    """
+    逐帧编码gif，每帧单独量化为局部颜色表后直接写入输出，不保留已写入的帧
+    指定全局颜色表时，已使用该颜色表的帧不再写入局部颜色表
+    """
+
+    def __init__(
+        self,
+        output: BinaryIO,
+        color_table: bytes = b"",
+        size: Optional[tuple[int, int]] = None,
+        background: int = 0,
+    ):
+        """
+        :params
+          * ``output``: 输出
+          * ``color_table``: 可选，全局颜色表，颜色数需要为 2 的幂
+          * ``size``: 可选，画面尺寸，默认为第一帧的尺寸
+          * ``background``: 背景色在全局颜色表中的索引
+        """
+        self.output = output
+        self.color_table = color_table
+        self.size = size
+        self.background = background
+        self.n_frames = 0
+
+    def write(
+        self,
+        frame: IMG,
+        delay: int,
+        disposal: int = 2,
+        position: tuple[int, int] = (0, 0),
+    ):
+        """
+        :params
+          * ``frame``: 帧图像
+          * ``delay``: 帧间隔，单位为 1/100 秒
+          * ``disposal``: 处置方式
+          * ``position``: 帧在画面中的位置
+        """
+        buffer = BytesIO()
+        frame.save(buffer, format="GIF", optimize=False)
+        stream = parse_gif(buffer.getvalue())
+
+        if self.n_frames == 0:
+            width, height = self.size or (stream.width, stream.height)
+            self.output.write(
+                logical_screen(width, height, self.color_table, self.background)
+            )
+            self.output.write(NETSCAPE_LOOP)
+
+        # 单帧gif的全局颜色表与输出的全局颜色表不同时，转为局部颜色表
+        color_table = stream.header[13:]
+        table_bits = stream.header[10] & 0x07
+        for gif_frame in stream.frames:
+            data = gif_frame.data
+            if color_table and color_table != self.color_table and not data[9] & 0x80:
+                flags = data[9] | 0x80 | table_bits
+                data = data[:9] + bytes([flags]) + color_table + data[10:]
+            if position != (0, 0):
+                data = data[:1] + struct.pack("<HH", *position) + data[5:]
+            self.output.write(
+                graphic_control_extension(delay, disposal, gif_frame.transparency)
+            )
+            self.output.write(data)
+            self.n_frames += 1
+
+    def close(self):
+        self.output.write(b"\x3b")
+
+
+def decode_frame(stream: GifStream, frame: GifFrame) -> IMG:
+    """
+    单独解码一帧的原始图像，不与之前的画面合成，
+    结果为使用该帧颜色表的调色板模式（灰度颜色表时为灰度模式）图像
+    """
+    data = (
+        b"GIF89a"
+        + struct.pack("<HH", frame.width, frame.height)
+        + stream.header[10:]
+        + graphic_control_extension(0, 0, frame.transparency)
+        + frame.data[:1]
+        + struct.pack("<HH", 0, 0)
+        + frame.data[5:]
+        + b"\x3b"
+    )
+    image = Image.open(BytesIO(data))
+    image.load()
+    return image
+
+
+def transpose_position(
+    rect: tuple[int, int, int, int], size: tuple[int, int], method: Transpose
+) -> Optional[tuple[int, int]]:
+    """
+    翻转或旋转画面后，帧在画面中的新位置
+    :params
+      * ``rect``: 帧的位置和尺寸
+      * ``size``: 变换前的画面尺寸
+      * ``method``: 翻转或旋转方式，不支持时返回 ``None``
+    """
+    left, top, w, h = rect
+    width, height = size
+    right, bottom = width - left - w, height - top - h
+    if method == Transpose.FLIP_LEFT_RIGHT:
+        return right, top
+    if method == Transpose.FLIP_TOP_BOTTOM:
+        return left, bottom
+    if method == Transpose.ROTATE_180:
+        return right, bottom
+    # 逆时针旋转 90 度时，(x, y) 变换为 (y, width - 1 - x)
+    if method == Transpose.ROTATE_90:
+        return top, right
+    if method == Transpose.ROTATE_270:
+        return bottom, left
+
+
+def merge_repeated_frames(frames: list[GifFrame]) -> list[tuple[GifFrame, int]]:
+    """
+    合并连续重复的原始帧，返回帧和合并后的帧间隔
+    恢复背景的帧有透明色时，重复绘制会露出背景而不是之前的画面，不合并
+    """
+    merged: list[tuple[GifFrame, int]] = []
+    for frame in frames:
+        delay = frame.delay or 0
+        if merged:
+            last, last_delay = merged[-1]
+            if (
+                frame.data == last.data
+                and frame.disposal == last.disposal
+                and frame.transparency == last.transparency
+                and not (frame.disposal == 2 and frame.transparency is not None)
+                and last_delay + delay <= 0xFFFF
+            ):
+                merged[-1] = (last, last_delay + delay)
+                continue
+        merged.append((frame, delay))
+    return merged
+
+
+def transform_gif(
+    data: bytes,
+    method: Optional[Transpose] = None,
+    box: Optional[tuple[int, int, int, int]] = None,
+) -> Optional[BytesIO]:
+    """
+    对 gif 的每一帧原始图像做裁剪、翻转、旋转等只移动像素的变换后重新编码，
+    各帧保留原有的颜色表、透明色、处置方式和帧间隔，不需要合成画面和重新量化，
+    播放时合成的画面与变换合成后的画面一致，连续重复的帧合并为一帧
+    :params
+      * ``data``: gif文件字节
+      * ``method``: 可选，翻转或旋转方式
+      * ``box``: 可选，在翻转或旋转之前裁剪的区域
+    :return
+      * 不支持的变换、有帧超出画面或完全在裁剪区域之外、
+        或结果超出大小限制时返回 ``None``
+    """
+    try:
+        stream = parse_gif(data)
+    except ValueError:
+        return None
+
+    width, height = stream.width, stream.height
+    x0, y0, x1, y1 = box or (0, 0, width, height)
+    if not (0 <= x0 < x1 <= width and 0 <= y0 < y1 <= height):
+        return None
+    size = (x1 - x0, y1 - y0)
+    if method in (Transpose.ROTATE_90, Transpose.ROTATE_270):
+        size = (size[1], size[0])
+
+    output = BytesIO()
+    writer = GifWriter(output, stream.header[13:], size, stream.header[11])
+    for frame, delay in merge_repeated_frames(stream.frames):
+        check_deadline()
+        if frame.left + frame.width > width or frame.top + frame.height > height:
+            return None
+        # 帧与裁剪区域的交集，坐标相对于帧
+        left, top = max(x0 - frame.left, 0), max(y0 - frame.top, 0)
+        right = min(x1 - frame.left, frame.width)
+        bottom = min(y1 - frame.top, frame.height)
+        if left >= right or top >= bottom:
+            return None
+
+        image = decode_frame(stream, frame)
+        if image.mode not in ("P", "L"):
+            return None
+        if (left, top, right, bottom) != (0, 0, frame.width, frame.height):
+            image = image.crop((left, top, right, bottom))
+        position = (frame.left + left - x0, frame.top + top - y0)
+        if method is not None:
+            rect = (*position, image.width, image.height)
+            position = transpose_position(rect, (x1 - x0, y1 - y0), method)
+            if position is None:
+                return None
+            image = image.transpose(method)
+        writer.write(image, delay, frame.disposal, position)
+    writer.close()
+
+    if output.getbuffer().nbytes > imagetools_config.imagetools_gif_max_size * 10**6:
+        return None
+    return output
@@ -0,0 +1,118 @@
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional
+
+
+class JobCancelled(Exception):
+    """任务已被取消"""
+
+
+class JobTimeout(JobCancelled):
+    """任务超出了处理时间上限"""
+
+
+@dataclass
+class JobStats:
+    """
+    单次指令执行过程中的统计信息
+    """
+
+    encode_passes: int = 0
+    """gif 完整编码的次数"""
+    gif_shrunk: bool = False
+    """gif 是否因超出大小限制而缩减了帧数或尺寸"""
+    encode_time: float = 0
+    """编码输出图片所用的时间，单位为秒"""
+    deadline: Optional[float] = None
+    """处理截止时间，为 ``time.monotonic()`` 的值"""
+    cancelled: bool = False
+    """任务是否已被取消，处理函数在帧之间检查后停止"""
+    degraded: bool = False
+    """是否以降低帧数和分辨率的方式处理"""
+    parallel: bool = False
+    """处理函数是否可以在多个线程中同时处理 gif 的不同帧"""
+    scalable: bool = False
+    """处理结果是否与输入尺寸成比例，gif 需要缩小时可以先缩小输入帧再处理"""
+    animated_format: str = "gif"
+    """动图的输出格式"""
+
+
+_job_stats: ContextVar[JobStats] = ContextVar("imagetools_job_stats")
+
+
+def new_job_stats(
+    timeout: Optional[float] = None,
+    degraded: bool = False,
+    parallel: bool = False,
+    animated_format: str = "gif",
+    scalable: bool = False,
+) -> JobStats:
+    """
+    为当前上下文创建新的统计信息
+    :params
+      * ``timeout``: 处理时间上限，单位为秒，为 ``None`` 时不限制
+      * ``degraded``: 是否以降低帧数和分辨率的方式处理
+      * ``parallel``: 处理函数是否可以并行处理 gif 的不同帧
+      * ``animated_format``: 动图的输出格式，可选 ``gif``、``webp``、``apng``
+      * ``scalable``: 处理结果是否与输入尺寸成比例
+    """
+    stats = JobStats(
+        degraded=degraded,
+        parallel=parallel,
+        animated_format=animated_format,
+        scalable=scalable,
+    )
+    if timeout is not None:
+        stats.deadline = time.monotonic() + timeout
+    _job_stats.set(stats)
+    return stats
+
+
+def remaining_time(stats: JobStats) -> Optional[float]:
+    """距离截止时间的剩余秒数，没有截止时间时返回 ``None``"""
+    if stats.deadline is None:
+        return None
+    return max(stats.deadline - time.monotonic(), 0)
+
+
+def check_deadline():
+    """
+    检查当前任务是否已被取消或超时，在帧之间、编码之间调用
+    :raise
+      * ``JobCancelled``: 任务已被取消
+      * ``JobTimeout``: 任务已超时
+    """
+    stats = get_job_stats()
+    if stats.cancelled:
+        raise JobCancelled
+    if stats.deadline is not None and time.monotonic() > stats.deadline:
+        raise JobTimeout
+
+
+def get_job_stats() -> JobStats:
+    """获取当前上下文的统计信息，不存在时返回一个不被记录的空对象"""
+    try:
+        return _job_stats.get()
+    except LookupError:
+        return JobStats()
+
+
+def merge_job_stats(stats: JobStats, other: JobStats):
+    """将其他进程中记录的统计信息合并到当前统计信息"""
+    stats.encode_passes += other.encode_passes
+    stats.gif_shrunk = stats.gif_shrunk or other.gif_shrunk
+    stats.encode_time += other.encode_time
+
+
+@contextmanager
+def record_encode() -> Iterator[None]:
+    """记录编码输出图片所用的时间"""
+    stats = get_job_stats()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.encode_time += time.perf_counter() - start
@@ -0,0 +1,148 @@
+import struct
+import weakref
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Optional
+
+from PIL.Image import Image as IMG
+
+from .gif_stream import parse_gif
+
+DEFAULT_DURATION = 20
+"""帧中没有记录帧间隔时使用的默认值，单位为毫秒，与原先读取 Pillow 信息时的默认值一致"""
+
+
+@dataclass
+class ImageMeta:
+    format: str
+    width: int
+    height: int
+    durations: list[Optional[float]]
+    """每帧的帧间隔，单位为毫秒，未记录时为 ``None``"""
+    disposals: list[int]
+    """每帧的处置方式"""
+
+    @property
+    def n_frames(self) -> int:
+        return len(self.durations)
+
+    @property
+    def avg_duration(self) -> float:
+        """平均帧间隔，单位为秒"""
+        durations = [
+            DEFAULT_DURATION if duration is None else duration
+            for duration in self.durations
+        ]
+        return sum(durations) / len(durations) / 1000
+
+
+def scan_gif(data: bytes) -> ImageMeta:
+    stream = parse_gif(data)
+    return ImageMeta(
+        "GIF",
+        stream.width,
+        stream.height,
+        [None if f.delay is None else f.delay * 10 for f in stream.frames],
+        [f.disposal for f in stream.frames],
+    )
+
+
+def scan_png(data: bytes) -> ImageMeta:
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        raise ValueError("not a png file")
+    width = height = 0
+    durations: list[Optional[float]] = []
+    disposals: list[int] = []
+    animated = False
+    pos = 8
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack_from(">I4s", data, pos)
+        chunk = data[pos + 8 : pos + 8 + length]
+        if chunk_type == b"IHDR":
+            width, height = struct.unpack_from(">II", chunk)
+        elif chunk_type == b"acTL":
+            animated = True
+        elif chunk_type == b"fcTL" and len(chunk) >= 26:
+            delay_num, delay_den, disposal = struct.unpack_from(">HHB", chunk, 20)
+            durations.append(delay_num / (delay_den or 100) * 1000)
+            disposals.append(disposal)
+        elif chunk_type == b"IDAT" and not durations:
+            # 默认图像不属于动画时，Pillow 仍将其作为第一帧
+            durations.append(None)
+            disposals.append(0)
+        elif chunk_type == b"IEND":
+            break
+        pos += length + 12
+    if not animated or not durations:
+        durations, disposals = [None], [0]
+    return ImageMeta("PNG", width, height, durations, disposals)
+
+
+def scan_webp(data: bytes) -> ImageMeta:
+    if data[:4] != b"RIFF" or data[8:12] != b"WEBP":
+        raise ValueError("not a webp file")
+    width = height = 0
+    durations: list[Optional[float]] = []
+    disposals: list[int] = []
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_type, length = struct.unpack_from("<4sI", data, pos)
+        chunk = data[pos + 8 : pos + 8 + length]
+        if chunk_type == b"VP8X":
+            width = int.from_bytes(chunk[4:7], "little") + 1
+            height = int.from_bytes(chunk[7:10], "little") + 1
+        elif chunk_type == b"ANMF":
+            durations.append(int.from_bytes(chunk[12:15], "little"))
+            disposals.append(chunk[15] & 0x01)
+        elif chunk_type == b"VP8 " and not width:
+            w, h = struct.unpack_from("<HH", chunk, 6)
+            width, height = w & 0x3FFF, h & 0x3FFF
+        elif chunk_type == b"VP8L" and not width:
+            bits = int.from_bytes(chunk[1:5], "little")
+            width, height = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        pos += 8 + length + (length & 1)
+    if not durations:
+        durations, disposals = [None], [0]
+    return ImageMeta("WEBP", width, height, durations, disposals)
+
+
+def scan_image(data: bytes) -> Optional[ImageMeta]:
+    """
+    不解码图像数据，从原始字节中读取 gif、apng、webp 的尺寸、帧数、帧间隔和处置方式
+    """
+    try:
+        if data[:3] == b"GIF":
+            return scan_gif(data)
+        if data[:4] == b"\x89PNG":
+            return scan_png(data)
+        if data[:4] == b"RIFF":
+            return scan_webp(data)
+    except (ValueError, IndexError, struct.error):
+        pass
+
+
+def get_image_bytes(image: IMG) -> Optional[bytes]:
+    """
+    获取从内存打开的图片的原始字节
+    """
+    fp = getattr(image, "fp", None)
+    if isinstance(fp, BytesIO):
+        return fp.getvalue()
+
+
+_meta_cache: dict[int, Optional[ImageMeta]] = {}
+
+
+def get_image_meta(image: IMG) -> Optional[ImageMeta]:
+    """
+    获取图片的元数据，结果在图片对象存活期间缓存
+    """
+    key = id(image)
+    if key in _meta_cache:
+        return _meta_cache[key]
+    meta = None
+    if data := get_image_bytes(image):
+        meta = scan_image(data)
+    _meta_cache[key] = meta
+    weakref.finalize(image, _meta_cache.pop, key, None)
+    return meta
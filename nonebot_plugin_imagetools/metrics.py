@@ -0,0 +1,293 @@
+import math
+import time
+from collections import defaultdict, deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Any, Optional, Protocol
+
+from nonebot import get_driver
+from nonebot.drivers import URL, ASGIMixin, HTTPServerSetup, Request, Response
+from nonebot.log import logger
+from PIL.Image import Image as IMG
+
+from .config import imagetools_config
+from .metadata import scan_image
+from .utils import get_n_frames
+
+STAGES = ("fetch", "decode", "queue", "process", "encode", "send", "total")
+"""
+指令执行的各个阶段，``decode`` 为读取文件头和预检，``queue`` 为排队等待，
+Pillow 延迟解码的部分计入 ``process``，``process`` 不包含 ``encode`` 的用时
+"""
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+"""Prometheus 直方图的分桶，单位为秒"""
+
+
+@dataclass
+class CommandMetrics:
+    """
+    单次指令执行的指标
+    """
+
+    keyword: str
+    stages: dict[str, float] = field(default_factory=dict)
+    """各阶段用时，单位为秒"""
+    input_bytes: int = 0
+    output_bytes: int = 0
+    input_images: int = 0
+    input_frames: int = 0
+    output_frames: int = 0
+    gif_shrunk: bool = False
+    cached: bool = False
+    """是否直接使用了缓存的结果"""
+    shared: bool = False
+    """是否复用了同时进行的相同请求的处理结果"""
+    timed_out: bool = False
+    """处理是否超时"""
+    degraded: bool = False
+    """超时后是否以降级处理的结果作为输出"""
+    status: str = "ok"
+    """
+    执行结果，``ok``、``rejected``（向用户返回了提示信息）、
+    ``timeout``（超时且没有降级处理的结果）或 ``error``
+    """
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """记录一个阶段的用时，同一阶段多次记录时累加"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0) + elapsed
+
+    def add_input(self, image: IMG):
+        """记录输入图片的大小和帧数，帧数从文件头读取，不解码图片"""
+        fp = getattr(image, "fp", None)
+        if isinstance(fp, BytesIO):
+            with fp.getbuffer() as buffer:
+                self.input_bytes += buffer.nbytes
+        self.input_images += 1
+        self.input_frames += get_n_frames(image)
+
+    def set_output(self, result: Any):
+        """根据处理结果记录输出大小和帧数，帧数从文件头读取，不解码图片"""
+        outputs = result if isinstance(result, list) else [result]
+        for output in outputs:
+            if not isinstance(output, BytesIO):
+                continue
+            data = output.getvalue()
+            self.output_bytes += len(data)
+            meta = scan_image(data)
+            self.output_frames += meta.n_frames if meta else 1
+
+
+class MetricsSink(Protocol):
+    def record(self, metrics: CommandMetrics): ...
+
+
+def quantile(values: list[float], q: float) -> float:
+    """最近秩法计算分位数，``values`` 需已排序"""
+    return values[max(math.ceil(q * len(values)) - 1, 0)]
+
+
+class HistogramSink:
+    """
+    在内存中保留每个指令最近的执行记录，用于计算各阶段用时的分位数
+    """
+
+    def __init__(self, window: int):
+        self.window = window
+        self.durations: dict[str, dict[str, deque[float]]] = defaultdict(
+            lambda: defaultdict(lambda: deque(maxlen=self.window))
+        )
+        self.counts: dict[str, int] = defaultdict(int)
+        self.timeouts: dict[str, int] = defaultdict(int)
+
+    def record(self, metrics: CommandMetrics):
+        self.counts[metrics.keyword] += 1
+        self.timeouts[metrics.keyword] += metrics.timed_out
+        for stage, duration in metrics.stages.items():
+            self.durations[metrics.keyword][stage].append(duration)
+
+    def quantiles(self, keyword: str, stage: str) -> Optional[list[float]]:
+        values = sorted(self.durations[keyword].get(stage, ()))
+        if not values:
+            return None
+        return [quantile(values, q) for q in QUANTILES]
+
+    def summary(self) -> str:
+        """各指令各阶段用时的 p50/p95/p99，单位为毫秒"""
+        lines: list[str] = []
+        for keyword in sorted(self.durations, key=lambda k: -self.counts[k]):
+            count = f"{self.counts[keyword]}次"
+            if timeouts := self.timeouts[keyword]:
+                count += f"，超时{timeouts}次"
+            lines.append(f"{keyword}（{count}）")
+            for stage in STAGES:
+                if result := self.quantiles(keyword, stage):
+                    p50, p95, p99 = (round(v * 1000) for v in result)
+                    lines.append(f"  {stage}: {p50} / {p95} / {p99}")
+        if not lines:
+            return "暂无指令执行记录"
+        return "\n".join(["用时 p50 / p95 / p99（毫秒）", *lines])
+
+
+class LoggingSink:
+    """
+    每次指令执行后输出一条日志
+    """
+
+    def record(self, metrics: CommandMetrics):
+        stages = ", ".join(
+            f"{stage} {metrics.stages[stage] * 1000:.0f}ms"
+            for stage in STAGES
+            if stage in metrics.stages
+        )
+        logger.info(
+            f"{metrics.keyword} [{metrics.status}"
+            + (", cached" if metrics.cached else "")
+            + (", shared" if metrics.shared else "")
+            + (", timed out" if metrics.timed_out else "")
+            + (", degraded" if metrics.degraded else "")
+            + (", gif shrunk" if metrics.gif_shrunk else "")
+            + f"]: {stages}; "
+            f"input {metrics.input_bytes} bytes / {metrics.input_frames} frames, "
+            f"output {metrics.output_bytes} bytes / {metrics.output_frames} frames"
+        )
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class PrometheusSink:
+    """
+    累计各指令的执行指标，以 Prometheus 文本格式输出
+    """
+
+    COUNTERS = {
+        "input_bytes": "输入图片的总字节数",
+        "output_bytes": "输出图片的总字节数",
+        "input_frames": "输入图片的总帧数",
+        "output_frames": "输出图片的总帧数",
+        "gif_shrunk": "gif 因超出大小限制而缩减的次数",
+        "cached": "使用缓存结果的次数",
+        "shared": "复用同时进行的相同请求的处理结果的次数",
+        "timed_out": "处理超时的次数",
+        "degraded": "超时后以降级处理的结果作为输出的次数",
+    }
+
+    def __init__(self):
+        self.buckets: dict[tuple[str, str], list[int]] = {}
+        self.sums: dict[tuple[str, str], float] = defaultdict(float)
+        self.statuses: dict[tuple[str, str], int] = defaultdict(int)
+        self.counters: dict[tuple[str, str], float] = defaultdict(float)
+
+    def record(self, metrics: CommandMetrics):
+        keyword = metrics.keyword
+        self.statuses[(keyword, metrics.status)] += 1
+        for name in self.COUNTERS:
+            self.counters[(name, keyword)] += getattr(metrics, name)
+        for stage, duration in metrics.stages.items():
+            key = (keyword, stage)
+            buckets = self.buckets.setdefault(key, [0] * (len(BUCKETS) + 1))
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    buckets[i] += 1
+            buckets[-1] += 1
+            self.sums[key] += duration
+
+    def exposition(self) -> str:
+        lines = [
+            "# HELP imagetools_stage_seconds 指令各阶段用时",
+            "# TYPE imagetools_stage_seconds histogram",
+        ]
+        for (keyword, stage), buckets in sorted(self.buckets.items()):
+            labels = f'command="{_escape_label(keyword)}",stage="{stage}"'
+            for bound, count in zip((*BUCKETS, "+Inf"), buckets):
+                lines.append(
+                    f'imagetools_stage_seconds_bucket{{{labels},le="{bound}"}} {count}'
+                )
+            total = self.sums[(keyword, stage)]
+            lines.append(f"imagetools_stage_seconds_sum{{{labels}}} {total}")
+            lines.append(f"imagetools_stage_seconds_count{{{labels}}} {buckets[-1]}")
+
+        lines.append("# HELP imagetools_commands_total 指令执行次数")
+        lines.append("# TYPE imagetools_commands_total counter")
+        for (keyword, status), count in sorted(self.statuses.items()):
+            lines.append(
+                f'imagetools_commands_total{{command="{_escape_label(keyword)}",'
+                f'status="{status}"}} {count}'
+            )
+
+        for name, help_text in self.COUNTERS.items():
+            metric = f"imagetools_{name}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for (counter, keyword), value in sorted(self.counters.items()):
+                if counter == name:
+                    lines.append(
+                        f'{metric}{{command="{_escape_label(keyword)}"}} {value:g}'
+                    )
+        return "\n".join(lines) + "\n"
+
+
+histogram_sink: Optional[HistogramSink] = None
+prometheus_sink: Optional[PrometheusSink] = None
+metrics_sinks: list[MetricsSink] = []
+
+
+def add_sink(sink: MetricsSink):
+    """添加自定义的指标输出方式"""
+    metrics_sinks.append(sink)
+
+
+def record_metrics(metrics: CommandMetrics):
+    for sink in metrics_sinks:
+        try:
+            sink.record(metrics)
+        except Exception as e:
+            logger.warning(f"Failed to record imagetools metrics: {e!r}")
+
+
+def _setup_sinks():
+    global histogram_sink, prometheus_sink
+    config = imagetools_config.imagetools_metrics_config
+    if "histogram" in config.sinks:
+        histogram_sink = HistogramSink(config.window)
+        add_sink(histogram_sink)
+    if "logging" in config.sinks:
+        add_sink(LoggingSink())
+    if "prometheus" in config.sinks:
+        prometheus_sink = PrometheusSink()
+        add_sink(prometheus_sink)
+        driver = get_driver()
+        if not isinstance(driver, ASGIMixin):
+            logger.warning(
+                "imagetools prometheus metrics require a driver with HTTP server"
+            )
+            return
+
+        async def handle(request: Request) -> Response:
+            assert prometheus_sink
+            return Response(
+                200,
+                headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+                content=prometheus_sink.exposition(),
+            )
+
+        driver.setup_http_server(
+            HTTPServerSetup(
+                URL(config.prometheus_path), "GET", "imagetools_metrics", handle
+            )
+        )
+
+
+_setup_sinks()
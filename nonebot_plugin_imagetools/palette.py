@@ -0,0 +1,236 @@
+from typing import Optional, cast
+
+from PIL import Image
+from PIL.Image import Image as IMG
+
+PALETTE_SIZE = 256
+"""gif 调色板的最大颜色数"""
+PALETTE_SAMPLE_SIZE = 256
+"""生成全局调色板时，采样帧缩小到的最大边长"""
+ALPHA_THRESHOLD = 128
+"""不透明度低于该值的像素作为透明色"""
+
+
+def has_alpha(image: IMG) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+
+
+def is_indexed(image: IMG) -> bool:
+    """是否为使用 rgb 调色板、最多只有一个透明色索引的调色板模式图像"""
+    return (
+        image.mode == "P"
+        and image.palette is not None
+        and image.palette.mode == "RGB"
+        and isinstance(image.info.get("transparency"), (int, type(None)))
+    )
+
+
+def opaque_colors(image: IMG) -> Optional[set[tuple[int, int, int]]]:
+    """
+    帧中不透明像素的颜色，颜色数超出调色板大小时返回 ``None``
+    """
+    transparency = image.info.get("transparency")
+    if is_indexed(image):
+        # 调色板模式直接统计使用的索引，不需要转换
+        indexes = cast(list[tuple[int, int]], image.getcolors(PALETTE_SIZE))
+        palette = image.getpalette() or []
+        return {
+            (palette[i * 3], palette[i * 3 + 1], palette[i * 3 + 2])
+            for _, i in indexes
+            if i != transparency and i * 3 + 2 < len(palette)
+        }
+    if image.mode == "RGB" and transparency is None:
+        rgb_colors = cast(
+            Optional[list[tuple[int, tuple[int, int, int]]]],
+            image.getcolors(PALETTE_SIZE),
+        )
+        return None if rgb_colors is None else {color for _, color in rgb_colors}
+    colors = cast(
+        Optional[list[tuple[int, tuple[int, int, int, int]]]],
+        image.convert("RGBA").getcolors(PALETTE_SIZE * 4),
+    )
+    if colors is None:
+        return None
+    result = {(r, g, b) for _, (r, g, b, a) in colors if a >= ALPHA_THRESHOLD}
+    return result if len(result) <= PALETTE_SIZE else None
+
+
+class GifPalette:
+    """
+    所有帧共用的 gif 调色板，包含一个透明色
+    """
+
+    def __init__(self, colors: list[int], transparency: int, exact: bool = False):
+        """
+        :params
+          * ``colors``: 调色板颜色，rgb 依次排列，颜色数补齐为 2 的幂
+          * ``transparency``: 透明色索引
+          * ``exact``: 调色板是否只包含采样帧中的颜色（复用源 gif 调色板或颜色较少时），
+            此时颜色数超出调色板大小的帧也单独生成调色板
+        """
+        n_colors = max(len(colors) // 3, transparency + 1, 2)
+        # gif 颜色表的大小为 2 的幂，颜色较少时使用较小的颜色表和编码位数
+        self.size = 1 << (n_colors - 1).bit_length()
+        colors = colors[: self.size * 3]
+        colors += [0] * (self.size * 3 - len(colors))
+        # 透明色使用与另一个索引相同的颜色，量化后的不透明像素不会只能匹配到透明色
+        self.alternative = 1 if transparency == 0 else 0
+        alternative = colors[self.alternative * 3 : self.alternative * 3 + 3]
+        colors[transparency * 3 : transparency * 3 + 3] = alternative
+        self.colors = bytes(colors)
+        self.transparency = transparency
+        self.exact = exact
+        self._indexes: dict[tuple[int, int, int], int] = {}
+        for i in range(self.size):
+            if i != transparency:
+                r, g, b = colors[i * 3 : i * 3 + 3]
+                self._indexes.setdefault((r, g, b), i)
+        self.color_set = set(self._indexes)
+        self.image = Image.new("P", (1, 1))
+        self.image.putpalette(colors)
+        self._lut = list(range(256))
+        self._lut[transparency] = self.alternative
+
+    @classmethod
+    def from_sample(cls, sample: list[IMG]) -> "GifPalette":
+        """
+        从采样帧生成调色板，采样帧都只使用某个源 gif 调色板中的颜色时
+        （如翻转、旋转、倒放等不改变颜色的操作）直接复用该调色板，
+        采样帧的颜色较少时直接使用这些颜色，否则用中位切分法生成
+        """
+        sample_colors = [opaque_colors(frame) for frame in sample]
+        for frame in sample:
+            if frame.mode == "P" and (palette := cls.reuse(frame, sample_colors)):
+                return palette
+
+        all_colors: set[tuple[int, int, int]] = set()
+        for colors in sample_colors:
+            if colors is None:
+                break
+            all_colors |= colors
+        else:
+            if len(all_colors) < PALETTE_SIZE:
+                return cls(
+                    [c for color in sorted(all_colors) for c in color],
+                    len(all_colors),
+                    exact=True,
+                )
+
+        thumbs: list[IMG] = []
+        for frame in sample:
+            thumb = frame.convert("RGBA")
+            # 最近邻缩小，不引入新的颜色
+            thumb.thumbnail(
+                (PALETTE_SAMPLE_SIZE, PALETTE_SAMPLE_SIZE), Image.Resampling.NEAREST
+            )
+            thumbs.append(thumb)
+        strip = Image.new(
+            "RGB", (sum(t.width for t in thumbs), max(t.height for t in thumbs))
+        )
+        x = 0
+        for thumb in thumbs:
+            mask = thumb.getchannel("A").point(
+                lambda a: 255 if a >= ALPHA_THRESHOLD else 0
+            )
+            strip.paste(thumb.convert("RGB"), (x, 0), mask)
+            x += thumb.width
+        quantized = strip.quantize(PALETTE_SIZE - 1, Image.Quantize.MEDIANCUT)
+        colors = (quantized.getpalette() or [])[: (PALETTE_SIZE - 1) * 3]
+        return cls(colors, len(colors) // 3)
+
+    @classmethod
+    def reuse(
+        cls, frame: IMG, sample_colors: list[Optional[set[tuple[int, int, int]]]]
+    ) -> Optional["GifPalette"]:
+        """采样帧的颜色都在该帧的调色板中，且调色板有空位作为透明色时，复用该调色板"""
+        colors = frame.getpalette() or []
+        n_colors = len(colors) // 3
+        transparency = frame.info.get("transparency")
+        if not isinstance(transparency, int):
+            if n_colors >= PALETTE_SIZE:
+                return None
+            transparency = n_colors
+        palette = cls(colors, transparency, exact=True)
+        if any(c is None or not c <= palette.color_set for c in sample_colors):
+            return None
+        return palette
+
+    def matches(self, frame: IMG) -> bool:
+        """调色板模式的帧是否已经使用该调色板，透明色的颜色不影响结果"""
+        colors = frame.getpalette() or []
+        transparency = frame.info.get("transparency")
+        if len(colors) > self.size * 3:
+            return False
+        if transparency != self.transparency and len(colors) > self.transparency * 3:
+            return False
+        padded = bytearray(colors).ljust(self.size * 3, b"\0")
+        start = self.transparency * 3
+        padded[start : start + 3] = self.colors[start : start + 3]
+        return padded == self.colors
+
+    def quantize(self, frame: IMG) -> IMG:
+        """
+        将帧转为使用该调色板的调色板模式图像，可以并行执行
+        颜色数不超过调色板大小的帧只在颜色都在该调色板中时无损转换，否则返回原帧，
+        编码时单独生成局部调色板；颜色更多的帧量化为调色板中最接近的颜色
+        """
+        if frame.mode == "P" and self.matches(frame):
+            return frame
+        colors = opaque_colors(frame)
+        if colors is None:
+            return frame if self.exact else self.nearest(frame)
+        if not colors <= self.color_set:
+            return frame
+        return self.remap(frame)
+
+    def remap(self, frame: IMG) -> IMG:
+        """将颜色都在该调色板中的帧无损转为使用该调色板"""
+        mask = None
+        if is_indexed(frame):
+            indexed = frame
+        else:
+            alpha = has_alpha(frame)
+            rgba = frame.convert("RGBA" if alpha else "RGB")
+            rgb = rgba.convert("RGB")
+            if alpha:
+                mask = rgba.getchannel("A").point(
+                    lambda a: 255 if a < ALPHA_THRESHOLD else 0
+                )
+                # 透明像素填充为调色板中的颜色，使颜色数不超过调色板大小
+                start = self.alternative * 3
+                rgb.paste(tuple(self.colors[start : start + 3]), mask=mask)
+            # Pillow 按给定调色板转换时会合并相近的颜色，
+            # 颜色数不超过调色板大小时自适应量化是无损的，再将索引映射到该调色板
+            indexed = rgb.quantize(PALETTE_SIZE, dither=Image.Dither.NONE)
+
+        colors = indexed.getpalette() or []
+        lut = [self.alternative] * 256
+        for i in range(min(len(colors) // 3, 256)):
+            r, g, b = colors[i * 3 : i * 3 + 3]
+            lut[i] = self._indexes.get((r, g, b), self.alternative)
+        transparency = indexed.info.get("transparency")
+        if isinstance(transparency, int):
+            lut[transparency] = self.transparency
+        result = indexed.point(lut)
+        result.putpalette(self.colors)
+        if mask is not None:
+            result.paste(self.transparency, mask=mask)
+        if mask is not None or isinstance(transparency, int):
+            result.info["transparency"] = self.transparency
+        return result
+
+    def nearest(self, frame: IMG) -> IMG:
+        """将帧量化为调色板中最接近的颜色"""
+        alpha = has_alpha(frame)
+        rgba = frame.convert("RGBA" if alpha else "RGB")
+        result = rgba.convert("RGB").quantize(
+            palette=self.image, dither=Image.Dither.NONE
+        )
+        result = result.point(self._lut)
+        if alpha:
+            mask = rgba.getchannel("A").point(
+                lambda a: 255 if a < ALPHA_THRESHOLD else 0
+            )
+            result.paste(self.transparency, mask=mask)
+            result.info["transparency"] = self.transparency
+        return result
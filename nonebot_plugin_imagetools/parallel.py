@@ -0,0 +1,98 @@
+import threading
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Callable, Optional, TypeVar
+
+from .config import imagetools_config
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+_worker = threading.local()
+
+
+def _init_worker():
+    _worker.active = True
+
+
+def get_thread_pool() -> Optional[ThreadPoolExecutor]:
+    """并行处理 gif 各帧或大图各区块的线程池，所有任务共用，未启用时返回 ``None``"""
+    global _pool
+    threads = imagetools_config.imagetools_parallel_config.threads
+    if threads <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                threads, thread_name_prefix="imagetools", initializer=_init_worker
+            )
+    return _pool
+
+
+def shutdown_thread_pool():
+    """关闭线程池，取消尚未开始的任务"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def frame_budget(frame_bytes: int) -> int:
+    """
+    同一任务可以同时保留在内存中的最大帧数，即内存预算平均到每个任务的份额能容纳的帧数
+    :params
+      * ``frame_bytes``: 一帧的预估内存占用，单位为字节
+    """
+    scheduler_config = imagetools_config.imagetools_scheduler_config
+    budget = scheduler_config.memory_budget * 10**6
+    budget /= max(scheduler_config.max_concurrency, 1)
+    return max(int(budget // max(frame_bytes, 1)), 1)
+
+
+def frame_window(frame_bytes: int) -> int:
+    """
+    同一任务同时处理中的最大帧数，不超过线程数的两倍，
+    且这些帧的内存占用不超过内存预算平均到每个任务的份额
+    :params
+      * ``frame_bytes``: 处理一帧时预估的内存占用，单位为字节
+    """
+    threads = imagetools_config.imagetools_parallel_config.threads
+    return max(min(threads * 2, frame_budget(frame_bytes)), 1)
+
+
+def parallel_map(
+    func: Callable[[T], R], items: Iterable[T], window: int
+) -> Iterator[R]:
+    """
+    在线程池中并行执行处理函数，按输入顺序依次返回结果
+    输入在调用方的线程中依次取出，未启用线程池、``window`` 为 ``1``
+    或已在线程池中（如并行处理各帧时处理大图区块）时，在当前线程中依次处理
+    :params
+      * ``func``: 处理函数，需要是线程安全的
+      * ``items``: 输入序列
+      * ``window``: 同时提交的最大任务数
+    """
+    pool = get_thread_pool()
+    # 在线程池中等待同一线程池的任务可能导致死锁
+    if pool is None or window <= 1 or getattr(_worker, "active", False):
+        yield from map(func, items)
+        return
+
+    pending: deque[Future[R]] = deque()
+    try:
+        for item in items:
+            # 在当前上下文的副本中执行，处理函数中可以获取同一任务的统计信息
+            pending.append(pool.submit(copy_context().run, func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # 出错或提前结束时，取消尚未开始的任务
+        for future in pending:
+            future.cancel()
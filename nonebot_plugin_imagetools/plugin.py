@@ -0,0 +1,519 @@
+import asyncio
+import imghdr
+import math
+import tempfile
+from datetime import datetime
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Optional
+from zipfile import ZIP_BZIP2, ZipFile
+
+from nonebot import require
+from nonebot.adapters import Bot, Event
+from nonebot.exception import MatcherException
+from nonebot.log import logger
+from nonebot.matcher import Matcher
+from nonebot.permission import SUPERUSER
+from nonebot.plugin import PluginMetadata, inherit_supported_adapters
+from nonebot.typing import T_State
+from nonebot.utils import run_sync
+from PIL.Image import Image as IMG
+from pil_utils import BuildImage, Text2Image
+
+require("nonebot_plugin_alconna")
+
+from nonebot_plugin_alconna import (
+    AlcMatches,
+    Alconna,
+    CustomNode,
+    Image,
+    SerializeFailed,
+    UniMessage,
+    get_target,
+    on_alconna,
+)
+from nonebot_plugin_alconna.builtins.extensions.reply import ReplyMergeExtension
+from nonebot_plugin_alconna.uniseg.tools import image_fetch
+
+from .cache import result_cache
+from .command import Command, commands
+from .config import Config, imagetools_config
+from .executor import run_func
+from .job import JobTimeout, merge_job_stats, new_job_stats
+from .metrics import CommandMetrics, histogram_sink, record_metrics
+from .precompute import precompute
+from .preflight import preflight_image
+from .scheduler import estimate_cost, get_scheduler
+from .singleflight import SingleFlight
+from .utils import get_animated_format
+
+__plugin_meta__ = PluginMetadata(
+    name="图片操作",
+    description="简单图片操作",
+    usage="发送“图片操作”查看支持的指令",
+    type="application",
+    homepage="https://github.com/noneplugin/nonebot-plugin-imagetools",
+    config=Config,
+    supported_adapters=inherit_supported_adapters("nonebot_plugin_alconna"),
+)
+
+
+help_cmd = on_alconna(
+    "图片操作", aliases={"图片工具"}, block=True, priority=13, use_cmd_start=True
+)
+
+
+@help_cmd.handle()
+async def _():
+    img = await help_image.get_async()
+    await UniMessage.image(raw=img).send()
+
+
+stats_cmd = on_alconna(
+    "图片操作统计",
+    block=True,
+    priority=13,
+    use_cmd_start=True,
+    permission=SUPERUSER,
+)
+
+
+@stats_cmd.handle()
+async def _(matcher: Matcher):
+    if histogram_sink is None:
+        await matcher.finish("未启用指令用时统计")
+    await matcher.finish(histogram_sink.summary())
+
+
+@precompute(lambda: tuple(command.keywords for command in commands))
+def help_image() -> bytes:
+    head_text = "简单图片操作，支持的操作："
+    head = Text2Image.from_text(head_text, 30, font_style="bold").to_image(
+        padding=(20, 10)
+    )
+    col_imgs: list[IMG] = []
+    col_num = 2
+    num_per_col = math.ceil(len(commands) / col_num)
+    for idx in range(0, len(commands), num_per_col):
+        text_imgs: list[IMG] = []
+        for i, command in enumerate(commands[idx : idx + num_per_col]):
+            text = f"{idx + i + 1}. " + "/".join(command.keywords)
+            text_img = Text2Image.from_text(text, 30).to_image()
+            text_imgs.append(text_img)
+        w = max(img.width for img in text_imgs) + 40
+        h = sum(img.height for img in text_imgs) + 20
+        col_img = BuildImage.new("RGBA", (w, h), "white")
+        current_h = 10
+        for img in text_imgs:
+            col_img.paste(img, (20, current_h), alpha=True)
+            current_h += img.height
+        col_imgs.append(col_img.image)
+    w = max(sum(img.width for img in col_imgs), head.width)
+    h = head.height + max(img.height for img in col_imgs)
+    frame = BuildImage.new("RGBA", (w, h), "white")
+    frame.paste(head, alpha=True)
+    current_w = 0
+    for img in col_imgs:
+        frame.paste(img, (current_w, head.height), alpha=True)
+        current_w += img.width
+    return frame.save_jpg().getvalue()
+
+
+_fetch_semaphore: Optional[asyncio.Semaphore] = None
+_fetch_flight: SingleFlight[Optional[bytes]] = SingleFlight()
+_process_flight: SingleFlight[Any] = SingleFlight()
+
+
+def get_fetch_semaphore() -> asyncio.Semaphore:
+    global _fetch_semaphore
+    if _fetch_semaphore is None:
+        _fetch_semaphore = asyncio.Semaphore(
+            imagetools_config.imagetools_fetch_config.global_concurrency
+        )
+    return _fetch_semaphore
+
+
+async def fetch_images(
+    bot: Bot, event: Event, state: T_State, images: list[Image]
+) -> list[Optional[BuildImage]]:
+    """
+    并发下载图片，同一请求或同时进行的不同请求中相同的图片只下载一次，
+    每张图片下载完成后立即打开
+    """
+    global_semaphore = get_fetch_semaphore()
+    semaphore = asyncio.Semaphore(imagetools_config.imagetools_fetch_config.concurrency)
+
+    async def fetch(image: Image) -> Optional[bytes]:
+        async with semaphore, global_semaphore:
+            return await image_fetch(event, bot, state, image)
+
+    async def fetch_and_open(image: Image) -> Optional[BuildImage]:
+        key = (image.id, image.url, str(image.path) if image.path else None)
+        if not any(key):
+            content = await fetch(image)
+        else:
+            content, _ = await _fetch_flight.do(
+                (bot.self_id, *key), lambda: fetch(image)
+            )
+        if content:
+            return BuildImage.open(BytesIO(content))
+
+    return list(await asyncio.gather(*(fetch_and_open(image) for image in images)))
+
+
+def create_matcher(command: Command):
+    command_matcher = on_alconna(
+        Alconna(command.keywords[0], command.args),
+        aliases=set(command.keywords[1:]),
+        block=True,
+        priority=13,
+        use_cmd_start=True,
+        extensions=[ReplyMergeExtension()],
+    )
+
+    @command_matcher.handle()
+    async def _(
+        bot: Bot,
+        event: Event,
+        state: T_State,
+        matcher: Matcher,
+        alc_matches: AlcMatches,
+    ):
+        metrics = CommandMetrics(command.keywords[0])
+        try:
+            with metrics.stage("total"):
+                await handle_command(
+                    bot, event, state, matcher, command, alc_matches, metrics
+                )
+        except MatcherException:
+            raise
+        except Exception:
+            metrics.status = "error"
+            raise
+        finally:
+            record_metrics(metrics)
+
+
+async def handle_command(
+    bot: Bot,
+    event: Event,
+    state: T_State,
+    matcher: Matcher,
+    command: Command,
+    alc_matches: AlcMatches,
+    metrics: CommandMetrics,
+):
+    args = alc_matches.all_matched_args
+    images: list[Image] = []
+    if image := args.get("img"):
+        images.append(image)
+    if imgs := args.get("imgs"):
+        images.extend(imgs)
+    if images:
+        with metrics.stage("fetch"):
+            results = await fetch_images(bot, event, state, images)
+        fetched: list[BuildImage] = []
+        for img in results:
+            if img is None:
+                metrics.status = "rejected"
+                await matcher.finish("图片下载失败")
+            with metrics.stage("decode"):
+                metrics.add_input(img.image)
+                checked = await run_sync(preflight_image)(img)
+            if isinstance(checked, str):
+                metrics.status = "rejected"
+                await matcher.finish(checked)
+            fetched.append(checked)
+        if args.get("img"):
+            args["img"] = fetched.pop(0)
+        if args.get("imgs"):
+            args["imgs"] = fetched
+
+    animated_format = get_animated_format(bot.adapter.get_name())
+    cache_key = await run_sync(result_cache.make_key)(
+        command.keywords[0], args, animated_format
+    )
+    result = await run_sync(result_cache.get)(cache_key) if cache_key else None
+    if result is not None:
+        metrics.cached = True
+    elif cache_key:
+        # 相同图片、指令和参数的请求同时进行时，只处理一次
+        result, shared = await _process_flight.do(
+            cache_key,
+            lambda: process_command(
+                bot,
+                event,
+                matcher,
+                command,
+                args,
+                animated_format,
+                cache_key,
+                metrics,
+            ),
+        )
+        if shared:
+            metrics.shared = True
+            result = copy_result(result)
+    else:
+        result = await process_command(
+            bot, event, matcher, command, args, animated_format, cache_key, metrics
+        )
+    await run_sync(metrics.set_output)(result)
+
+    with metrics.stage("send"):
+        if isinstance(result, str):
+            if metrics.status == "ok":
+                metrics.status = "rejected"
+            await matcher.finish(result)
+        elif isinstance(result, BytesIO):
+            await UniMessage.image(raw=result).send()
+        elif isinstance(result, list):
+            await send_multiple_images(bot, event, command, result)
+        else:
+            metrics.status = "error"
+            await matcher.finish("出错了，请稍后再试")
+
+
+def copy_result(result: Any) -> Any:
+    """复制共享的处理结果，避免多个请求同时读取同一个 ``BytesIO``"""
+    if isinstance(result, BytesIO):
+        return BytesIO(result.getvalue())
+    if isinstance(result, list):
+        return [copy_result(r) for r in result]
+    return result
+
+
+def get_queue_group(bot: Bot, event: Event) -> str:
+    """
+    任务所在的排队分组，同一群聊的任务为一组，私聊的任务为一组
+    无法获取消息目标时（如适配器不支持），以会话为一组，不跳过指令
+    """
+    try:
+        target = get_target(event=event, bot=bot)
+    except (SerializeFailed, NotImplementedError, ValueError):
+        try:
+            return f"session:{event.get_session_id()}"
+        except (NotImplementedError, ValueError):
+            return ""
+    return "" if target.private else target.id
+
+
+async def process_command(
+    bot: Bot,
+    event: Event,
+    matcher: Matcher,
+    command: Command,
+    args: dict[str, Any],
+    animated_format: str,
+    cache_key: Optional[str],
+    metrics: CommandMetrics,
+) -> Any:
+    """
+    调度并执行处理函数，无法处理时返回提示信息
+    """
+    ticket = get_scheduler().submit(
+        get_queue_group(bot, event),
+        event.get_user_id(),
+        await run_sync(estimate_cost)(args, animated_format, command.all_frames),
+    )
+    if ticket is None:
+        metrics.status = "rejected"
+        return "当前处理的图片过多，请稍后再试"
+    if (
+        not ticket.started
+        and imagetools_config.imagetools_scheduler_config.queued_notice
+    ):
+        position = get_scheduler().position(ticket)
+        try:
+            await matcher.send(f"图片处理中，前面还有 {position} 个任务")
+        except Exception:
+            ticket.cancel()
+            raise
+
+    with metrics.stage("queue"):
+        await ticket.wait()
+    # 排队用时不计入处理时间上限，开始处理时再设置截止时间
+    timeout_config = imagetools_config.imagetools_timeout_config
+    stats = new_job_stats(
+        timeout_config.timeout or None,
+        parallel=command.parallel,
+        animated_format=animated_format,
+        scalable=command.scalable,
+    )
+    try:
+        with metrics.stage("process"):
+            try:
+                result = await run_func(command.func, args)
+            except JobTimeout:
+                metrics.timed_out = True
+                result = None
+            # 输入包含动图时，超时后减少帧数、缩小尺寸重新处理
+            animated = metrics.input_frames > metrics.input_images
+            if metrics.timed_out and animated and timeout_config.degraded_timeout:
+                degraded_stats = new_job_stats(
+                    timeout_config.degraded_timeout,
+                    degraded=True,
+                    parallel=command.parallel,
+                    animated_format=animated_format,
+                    scalable=command.scalable,
+                )
+                try:
+                    result = await run_func(command.func, args)
+                    metrics.degraded = True
+                except JobTimeout:
+                    pass
+                merge_job_stats(stats, degraded_stats)
+    finally:
+        ticket.release()
+    # 编码在处理函数中进行，从处理用时中拆分出来
+    metrics.stages["process"] -= stats.encode_time
+    metrics.stages["encode"] = stats.encode_time
+    metrics.gif_shrunk = stats.gif_shrunk
+    if stats.encode_passes:
+        logger.info(
+            f"{command.keywords[0]}: "
+            f"gif encoded in {stats.encode_passes} pass(es)"
+            + (", shrunk to fit size limit" if stats.gif_shrunk else "")
+        )
+    if result is None:
+        metrics.status = "timeout"
+        return "图片处理超时，请换一张较小的图片再试"
+    if cache_key and not metrics.degraded:
+        await run_sync(result_cache.set)(cache_key, result)
+    return result
+
+
+def create_matchers():
+    for command in commands:
+        create_matcher(command)
+
+
+create_matchers()
+
+
+async def send_multiple_images(
+    bot: Bot, event: Event, command: Command, images: list[BytesIO]
+):
+    config = imagetools_config.imagetools_multiple_image_config
+
+    if len(images) <= config.direct_send_threshold:
+        if config.send_one_by_one:
+            for img in images:
+                await UniMessage.image(raw=img).send()
+        else:
+            await UniMessage(Image(raw=img) for img in images).send()
+
+    else:
+        if config.send_zip_file:
+            zip_file = zip_images(images)
+            time_str = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+            filename = f"{command.keywords[0]}_{time_str}.zip"
+            await send_file(bot, event, filename, zip_file.getvalue())
+
+        if config.send_forward_msg:
+            await send_forward_msg(bot, event, images)
+
+
+def zip_images(files: list[BytesIO]):
+    output = BytesIO()
+    with ZipFile(output, "w", ZIP_BZIP2) as zip_file:
+        for i, file in enumerate(files):
+            file_bytes = file.getvalue()
+            ext = imghdr.what(None, h=file_bytes)
+            zip_file.writestr(f"{i}.{ext}", file_bytes)
+    return output
+
+
+async def send_file(bot: Bot, event: Event, filename: str, content: bytes):
+    try:
+        from nonebot.adapters.onebot.v11 import Bot as V11Bot
+        from nonebot.adapters.onebot.v11 import Event as V11Event
+        from nonebot.adapters.onebot.v11 import GroupMessageEvent as V11GMEvent
+
+        async def upload_file_v11(
+            bot: V11Bot, event: V11Event, filename: str, content: bytes
+        ):
+            with tempfile.TemporaryDirectory() as temp_dir:
+                with open(Path(temp_dir) / filename, "wb") as f:
+                    f.write(content)
+                if isinstance(event, V11GMEvent):
+                    await bot.call_api(
+                        "upload_group_file",
+                        group_id=event.group_id,
+                        file=f.name,
+                        name=filename,
+                    )
+                else:
+                    await bot.call_api(
+                        "upload_private_file",
+                        user_id=event.get_user_id(),
+                        file=f.name,
+                        name=filename,
+                    )
+
+        if isinstance(bot, V11Bot) and isinstance(event, V11Event):
+            await upload_file_v11(bot, event, filename, content)
+            return
+
+    except ImportError:
+        pass
+
+    await UniMessage.file(raw=content, name=filename, mimetype="application/zip").send()
+
+
+async def send_forward_msg(
+    bot: Bot,
+    event: Event,
+    images: list[BytesIO],
+):
+    try:
+        from nonebot.adapters.onebot.v11 import Bot as V11Bot
+        from nonebot.adapters.onebot.v11 import Event as V11Event
+        from nonebot.adapters.onebot.v11 import GroupMessageEvent as V11GMEvent
+        from nonebot.adapters.onebot.v11 import Message as V11Msg
+        from nonebot.adapters.onebot.v11 import MessageSegment as V11MsgSeg
+
+        async def send_forward_msg_v11(
+            bot: V11Bot,
+            event: V11Event,
+            name: str,
+            uin: str,
+            msgs: list[V11Msg],
+        ):
+            messages = [
+                {"type": "node", "data": {"name": name, "uin": uin, "content": msg}}
+                for msg in msgs
+            ]
+            if isinstance(event, V11GMEvent):
+                await bot.call_api(
+                    "send_group_forward_msg", group_id=event.group_id, messages=messages
+                )
+            else:
+                await bot.call_api(
+                    "send_private_forward_msg",
+                    user_id=event.get_user_id(),
+                    messages=messages,
+                )
+
+        if isinstance(bot, V11Bot) and isinstance(event, V11Event):
+            await send_forward_msg_v11(
+                bot,
+                event,
+                "imagetools",
+                bot.self_id,
+                [V11Msg(V11MsgSeg.image(img)) for img in images],
+            )
+            return
+
+    except ImportError:
+        pass
+
+    uid = bot.self_id
+    name = "imagetools"
+    time = datetime.now()
+    await UniMessage.reference(
+        *[
+            CustomNode(uid, name, UniMessage.image(raw=img.getvalue()), time)
+            for img in images
+        ]
+    ).send()
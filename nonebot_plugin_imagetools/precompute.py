@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from collections.abc import Hashable
+from typing import Callable, Generic, Optional, TypeVar
+
+from nonebot import get_driver
+from nonebot.log import logger
+from nonebot.utils import run_sync
+
+T = TypeVar("T")
+
+
+class Precomputed(Generic[T]):
+    """
+    确定性的计算结果，首次使用或启动时在后台计算一次，之后复用，版本键变化时重新计算
+    """
+
+    def __init__(
+        self, func: Callable[[], T], key: Optional[Callable[[], Hashable]] = None
+    ):
+        """
+        :params
+          * ``func``: 计算函数
+          * ``key``: 可选，返回结果所依赖输入的版本键，与上次计算时不同时重新计算
+        """
+        self.func = func
+        self.key = key or (lambda: None)
+        self._value: Optional[tuple[Hashable, T]] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> T:
+        key = self.key()
+        # 同时获取时只计算一次
+        with self._lock:
+            if self._value is None or self._value[0] != key:
+                self._value = (key, self.func())
+            return self._value[1]
+
+    async def get_async(self) -> T:
+        if self._value is not None and self._value[0] == self.key():
+            return self._value[1]
+        return await run_sync(self.get)()
+
+
+_precomputed: list[Precomputed] = []
+
+
+def precompute(
+    key: Optional[Callable[[], Hashable]] = None,
+) -> Callable[[Callable[[], T]], Precomputed[T]]:
+    """
+    将无参数的函数注册为预计算结果，启动时在后台计算
+    :params
+      * ``key``: 可选，返回结果所依赖输入的版本键，与上次计算时不同时重新计算
+    """
+
+    def decorator(func: Callable[[], T]) -> Precomputed[T]:
+        precomputed = Precomputed(func, key)
+        _precomputed.append(precomputed)
+        return precomputed
+
+    return decorator
+
+
+_background_tasks: set[asyncio.Task] = set()
+
+driver = get_driver()
+
+
+@driver.on_startup
+async def _():
+    async def compute(precomputed: Precomputed):
+        try:
+            await precomputed.get_async()
+        except Exception as e:
+            logger.warning(f"Failed to precompute {precomputed.func.__name__}: {e!r}")
+
+    # 不阻塞启动，在后台计算
+    for precomputed in _precomputed:
+        task = asyncio.create_task(compute(precomputed))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
@@ -0,0 +1,37 @@
+import math
+from io import BytesIO
+from typing import Union
+
+from PIL import Image
+from pil_utils import BuildImage
+
+from .config import imagetools_config
+from .utils import get_n_frames, scale_size
+
+
+def preflight_image(img: BuildImage) -> Union[BuildImage, str]:
+    """
+    解码前根据文件头中的尺寸和帧数检查图片，超出限制的静图缩小后重新打开，动图直接拒绝
+    :return
+      * 检查通过或缩小后的图片，拒绝处理时返回提示信息
+    """
+    config = imagetools_config.imagetools_image_limit_config
+    image = img.image
+    pixels = image.width * image.height
+    if pixels * get_n_frames(image) > config.max_total_pixels:
+        return "图片尺寸或帧数过大，无法处理"
+    if pixels <= config.max_image_pixels:
+        return img
+    if getattr(image, "is_animated", False):
+        return "图片尺寸过大，无法处理"
+
+    size = scale_size(image.size, math.sqrt(config.max_image_pixels / pixels))
+    # jpeg 图片直接以缩小的比例解码
+    image.draft(None, size)
+    image = image.resize(size, Image.Resampling.LANCZOS)
+    output = BytesIO()
+    if img.image.format == "JPEG":
+        image.save(output, format="JPEG", quality=95)
+    else:
+        image.save(output, format="PNG")
+    return BuildImage.open(output)
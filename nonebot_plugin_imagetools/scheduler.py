@@ -0,0 +1,217 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Any, Optional
+
+from pil_utils import BuildImage
+
+from .config import imagetools_config
+from .parallel import frame_window
+from .utils import BYTES_PER_PIXEL, GIF_SAMPLE_FRAMES, get_n_frames
+
+
+def estimate_frames(n_frames: int, frame_bytes: int, all_frames: bool) -> int:
+    """
+    处理动图时同时保留在内存中的帧数
+    :params
+      * ``n_frames``: 动图的帧数
+      * ``frame_bytes``: 一帧的内存占用，单位为字节
+      * ``all_frames``: 是否需要同时保留所有帧
+    """
+    if all_frames:
+        return n_frames
+    # 逐帧处理时只保留采样帧和并行处理中的帧，后者的输入帧和处理结果各占一份内存；
+    # 乱序读取时缓存的帧不超过内存预算平均到每个任务的份额，同时执行的任务之和不超出预算
+    window = frame_window(frame_bytes * 2) * 2
+    return min(n_frames, GIF_SAMPLE_FRAMES + window)
+
+
+def estimate_cost(
+    args: dict[str, Any], animated_format: str = "gif", all_frames: bool = False
+) -> int:
+    """
+    根据输入图片的像素数与处理时保留在内存中的帧数预估任务的内存占用，单位为字节
+    :params
+      * ``args``: 处理函数的参数
+      * ``animated_format``: 动图的输出格式，webp 和 apng 在取得所有帧后一次性编码
+      * ``all_frames``: 处理函数是否同时保留输入动图的所有帧
+    """
+    images: list[BuildImage] = []
+    if img := args.get("img"):
+        images.append(img)
+    if imgs := args.get("imgs"):
+        images.extend(imgs)
+    cost = 0
+    for img in images:
+        frame_bytes = img.width * img.height * BYTES_PER_PIXEL
+        n_frames = get_n_frames(img.image)
+        if n_frames > 1:
+            keep_all = all_frames or animated_format != "gif"
+            n_frames = estimate_frames(n_frames, frame_bytes, keep_all)
+        cost += frame_bytes * n_frames
+    return cost
+
+
+class Ticket:
+    """
+    调度器中的一个任务，通过 ``wait`` 等待开始执行，执行完成后调用 ``release`` 释放资源
+    """
+
+    def __init__(self, scheduler: "Scheduler", group: str, user: str, cost: int):
+        self.scheduler = scheduler
+        self.group = group
+        self.user = user
+        self.cost = cost
+        self.ready: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+    @property
+    def started(self) -> bool:
+        return self.ready.done()
+
+    def cancel(self):
+        """取消等待中的任务，已开始的任务则释放资源"""
+        self.scheduler._cancel(self)
+
+    async def wait(self):
+        try:
+            await self.ready
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+
+    def release(self):
+        self.scheduler._release(self)
+
+
+class Scheduler:
+    """
+    图片处理任务调度器，限制同时执行的任务数和预估内存占用，
+    等待中的任务在群组之间、同一群组的用户之间轮流执行
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        memory_budget: int,
+        max_queue_size: int,
+        max_user_queue_size: int,
+    ):
+        """
+        :params
+          * ``max_concurrency``: 同时执行的最大任务数
+          * ``memory_budget``: 同时执行的任务预估内存占用之和的上限，单位为字节
+          * ``max_queue_size``: 等待中的最大任务数
+          * ``max_user_queue_size``: 每个用户等待中的最大任务数
+        """
+        self.max_concurrency = max_concurrency
+        self.memory_budget = memory_budget
+        self.max_queue_size = max_queue_size
+        self.max_user_queue_size = max_user_queue_size
+        self.running = 0
+        self.memory = 0
+        self.waiting = 0
+        self._queues: OrderedDict[str, OrderedDict[str, deque[Ticket]]] = OrderedDict()
+
+    def submit(self, group: str, user: str, cost: int) -> Optional[Ticket]:
+        """
+        提交任务，资源充足且没有其他任务等待时立即开始，否则加入队列
+        :return
+          * 队列已满时返回 ``None``
+        """
+        # 单个任务超出内存预算时，按预算计算，等待其他任务完成后单独执行
+        ticket = Ticket(self, group, user, min(cost, self.memory_budget))
+        if not self.waiting and self._fits(ticket):
+            self._start(ticket)
+            return ticket
+
+        user_queue = self._queues.get(group, {}).get(user, ())
+        if (
+            self.waiting >= self.max_queue_size
+            or len(user_queue) >= self.max_user_queue_size
+        ):
+            return None
+        self._queues.setdefault(group, OrderedDict()).setdefault(user, deque()).append(
+            ticket
+        )
+        self.waiting += 1
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        """任务前面等待中的任务数，按当前的轮转顺序估算"""
+        position = 0
+        for user_queues in self._queues.values():
+            for queue in user_queues.values():
+                if ticket in queue:
+                    position += queue.index(ticket)
+                else:
+                    position += len(queue)
+        return position
+
+    def _fits(self, ticket: Ticket) -> bool:
+        return (
+            self.running < self.max_concurrency
+            and self.memory + ticket.cost <= self.memory_budget
+        )
+
+    def _start(self, ticket: Ticket):
+        self.running += 1
+        self.memory += ticket.cost
+        ticket.ready.set_result(None)
+
+    def _next(self) -> Optional[Ticket]:
+        """按群组、用户轮转选出下一个任务"""
+        for user_queues in self._queues.values():
+            for queue in user_queues.values():
+                return queue[0]
+
+    def _pop(self, ticket: Ticket):
+        user_queues = self._queues[ticket.group]
+        queue = user_queues[ticket.user]
+        queue.remove(ticket)
+        self.waiting -= 1
+        # 被选中的群组和用户移到队尾
+        del user_queues[ticket.user]
+        if queue:
+            user_queues[ticket.user] = queue
+        del self._queues[ticket.group]
+        if user_queues:
+            self._queues[ticket.group] = user_queues
+
+    def _dispatch(self):
+        # 队首的任务放不下时继续等待，不让较小的任务插队，避免大任务饿死
+        while (ticket := self._next()) and self._fits(ticket):
+            self._pop(ticket)
+            self._start(ticket)
+
+    def _cancel(self, ticket: Ticket):
+        queue = self._queues.get(ticket.group, {}).get(ticket.user)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            self.waiting -= 1
+            if not queue:
+                del self._queues[ticket.group][ticket.user]
+            if not self._queues[ticket.group]:
+                del self._queues[ticket.group]
+        elif ticket.started:
+            self._release(ticket)
+        self._dispatch()
+
+    def _release(self, ticket: Ticket):
+        self.running -= 1
+        self.memory -= ticket.cost
+        self._dispatch()
+
+
+_scheduler: Optional[Scheduler] = None
+
+
+def get_scheduler() -> Scheduler:
+    global _scheduler
+    if _scheduler is None:
+        config = imagetools_config.imagetools_scheduler_config
+        _scheduler = Scheduler(
+            config.max_concurrency,
+            int(config.memory_budget * 10**6),
+            config.max_queue_size,
+            config.max_user_queue_size,
+        )
+    return _scheduler
@@ -0,0 +1,51 @@
+import asyncio
+from collections.abc import Awaitable, Hashable
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """
+    合并相同的并发调用，同一时间相同键的调用只执行一次，其他调用等待并共享结果
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future[T]] = {}
+
+    async def do(
+        self, key: Hashable, func: Callable[[], Awaitable[T]]
+    ) -> tuple[T, bool]:
+        """
+        :params
+          * ``key``: 调用的键
+          * ``func``: 没有相同的调用正在执行时，执行该函数
+        :return
+          * 调用结果，以及结果是否来自其他调用
+        """
+        while (future := self._calls.get(key)) is not None:
+            try:
+                # 等待方被取消时不影响正在执行的调用
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # 执行方被取消时，由等待方重新执行
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有等待方时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
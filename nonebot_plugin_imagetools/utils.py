@@ -1,54 +1,551 @@
+import hashlib
 import math
+import os
+from collections.abc import Iterable, Iterator
 from enum import Enum
+from functools import partial
+from itertools import chain
 from io import BytesIO
-from typing import Callable
+from typing import Callable, NamedTuple, Optional, Union
 
+from nonebot.log import logger
+from PIL import Image
 from PIL.Image import Image as IMG
+from PIL.ImageFilter import Filter
 from pil_utils import BuildImage
 
 from .config import imagetools_config
+from .gif_stream import GifWriter
+from .job import check_deadline, get_job_stats, record_encode
+from .metadata import get_image_meta
+from .palette import GifPalette, has_alpha
+from .parallel import frame_budget, frame_window, parallel_map
+
+
+BYTES_PER_PIXEL = 4
+"""预估内存占用时每个像素占用的字节数，按 RGBA 计算"""
+GIF_SAMPLE_FRAMES = 5
+"""预估 gif 大小时采样的帧数"""
+GIF_SIZE_MARGIN = 0.9
+"""预估 gif 大小时预留的余量"""
+GIF_RETRY_MARGIN = 0.7
+"""按实际大小重新编码 gif 时预留的余量，取较小值以保证只需重新编码一次"""
+FRAME_KEY_STRIDE = 8
+"""比较帧内容时，缩略图中每个像素对应的原图边长"""
+
+TimedFrame = tuple[IMG, float]
+"""帧和该帧的帧间隔，帧间隔单位为秒"""
+
+
+def encode_gif(
+    frames: Iterable[TimedFrame], palette: Optional[GifPalette] = None
+) -> BytesIO:
+    """
+    逐帧编码gif，传入生成器时内存占用与帧数无关
+    :params
+      * ``frames``: 帧和帧间隔序列
+      * ``palette``: 可选，全局调色板，各帧在线程池中并行量化为该调色板
+    """
+    output = BytesIO()
+    writer = GifWriter(output, palette.colors if palette else b"")
+    if palette:
+        frames = quantize_frames(frames, palette)
+    for frame, duration in frames:
+        check_deadline()
+        with record_encode():
+            writer.write(frame, round(duration * 100))
+    with record_encode():
+        writer.close()
+    return output
+
+
+def quantize_frames(
+    frames: Iterable[TimedFrame], palette: GifPalette
+) -> Iterator[TimedFrame]:
+    frames = iter(frames)
+    if (first := next(frames, None)) is None:
+        return
+
+    def quantize(item: TimedFrame) -> TimedFrame:
+        return palette.quantize(item[0]), item[1]
+
+    # 量化前后的帧各占一份内存
+    frame_bytes = first[0].width * first[0].height * (BYTES_PER_PIXEL + 1)
+    yield from parallel_map(quantize, chain([first], frames), frame_window(frame_bytes))
 
 
-def save_gif(frames: list[IMG], duration: float) -> BytesIO:
+def normalize_frame(frame: IMG) -> IMG:
+    # 解码 gif 时第一帧为调色板模式，之后的帧为 rgb(a) 模式，统一按颜色比较
+    if frame.mode == "P":
+        return frame.convert("RGBA" if has_alpha(frame) else "RGB")
+    return frame
+
+
+class FrameKey:
+    """
+    用于比较帧内容是否相同，先比较按固定间隔取样的缩略图，相同时再比较完整内容的摘要，
+    内容不同的帧通常不需要计算完整摘要
+    """
+
+    def __init__(self, frame: IMG):
+        self.frame = frame
+        w, h = frame.size
+        thumb = frame.resize(
+            (max(w // FRAME_KEY_STRIDE, 1), max(h // FRAME_KEY_STRIDE, 1)),
+            Image.Resampling.NEAREST,
+        )
+        thumb = normalize_frame(thumb)
+        self.thumb = (
+            f"{thumb.mode}{frame.size}{thumb.info.get('transparency')}".encode()
+            + thumb.tobytes()
+        )
+        self._digest: Optional[bytes] = None
+
+    @property
+    def digest(self) -> bytes:
+        """完整内容的摘要"""
+        if self._digest is None:
+            frame = normalize_frame(self.frame)
+            digest = hashlib.sha1(
+                f"{frame.mode}{frame.size}{frame.info.get('transparency')}".encode()
+            )
+            digest.update(frame.tobytes())
+            self._digest = digest.digest()
+        return self._digest
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, FrameKey):
+            return NotImplemented
+        return other.frame is self.frame or (
+            other.thumb == self.thumb and other.digest == self.digest
+        )
+
+
+def merge_identical_frames(frames: Iterable[TimedFrame]) -> Iterator[TimedFrame]:
+    """
+    将内容相同的连续帧合并为一帧，帧间隔为这些帧的帧间隔之和
+    :params
+      * ``frames``: 帧和帧间隔序列，传入生成器时只额外保留一帧
+    """
+    last: Optional[FrameKey] = None
+    total_duration = 0.0
+    for frame, duration in frames:
+        # 同一个图像对象不需要比较内容
+        if last is None or frame is not last.frame:
+            key = FrameKey(frame)
+            if last is None or key != last:
+                if last is not None:
+                    yield last.frame, total_duration
+                last, total_duration = key, 0.0
+        total_duration += duration
+    if last is not None:
+        yield last.frame, total_duration
+
+
+def sample_palette(sample: list[IMG]) -> Optional[GifPalette]:
+    """
+    输出格式为 gif 且启用全局调色板时，从采样帧生成全局调色板
+    """
+    if (
+        not sample
+        or get_job_stats().animated_format != "gif"
+        or not imagetools_config.imagetools_output_config.gif_global_palette
+    ):
+        return None
+    with record_encode():
+        return GifPalette.from_sample(sample)
+
+
+def get_animated_format(adapter: str) -> str:
+    """
+    根据适配器名称确定动图的输出格式
+    :params
+      * ``adapter``: 适配器名称，如 ``OneBot V11``
+    """
+    config = imagetools_config.imagetools_output_config
+    return config.adapter_formats.get(adapter, config.animated_format)
+
+
+def encode_animation(
+    frames: Iterable[TimedFrame], palette: Optional[GifPalette] = None
+) -> BytesIO:
+    """
+    按当前任务的输出格式编码动图，gif 逐帧编码，webp 和 apng 在取得所有帧后一次性编码
+    :params
+      * ``frames``: 帧和帧间隔序列
+      * ``palette``: 可选，gif 的全局调色板
+    """
+    animated_format = get_job_stats().animated_format
+    if animated_format == "gif":
+        return encode_gif(frames, palette)
+
+    images: list[IMG] = []
+    durations: list[int] = []
+    for frame, duration in frames:
+        check_deadline()
+        images.append(frame)
+        durations.append(round(duration * 1000))
+    config = imagetools_config.imagetools_output_config
     output = BytesIO()
-    frames[0].save(
-        output,
-        format="GIF",
-        save_all=True,
-        append_images=frames[1:],
-        duration=duration * 1000,
-        loop=0,
-        disposal=2,
-        optimize=False,
-    )
+    with record_encode():
+        if animated_format == "webp":
+            # Pillow 转换带透明色的调色板模式帧时会丢弃透明度，预先转为 rgba
+            images = [
+                image
+                if image.mode in ("RGB", "RGBA")
+                else image.convert("RGBA" if has_alpha(image) else "RGB")
+                for image in images
+            ]
+            images[0].save(
+                output,
+                format="WEBP",
+                save_all=True,
+                append_images=images[1:],
+                duration=durations,
+                loop=0,
+                # 不使用 gif 帧中记录的背景色，否则透明区域会被填充
+                background=(0, 0, 0, 0),
+                quality=config.webp_quality,
+                method=config.webp_method,
+                lossless=config.webp_lossless,
+            )
+        else:
+            # apng 的各帧需要使用相同的模式，各帧调色板不同的 gif 帧统一转为 rgb(a)
+            mode = "RGBA" if any(has_alpha(image) for image in images) else "RGB"
+            images = [image.convert(mode) for image in images]
+            images[0].save(
+                output,
+                format="PNG",
+                save_all=True,
+                append_images=images[1:],
+                duration=durations,
+                loop=0,
+                compress_level=config.apng_compress_level,
+            )
+    return output
+
+
+def sample_indexes(n_frames: int) -> list[int]:
+    """
+    均匀选取用于预估gif大小的采样帧索引
+    """
+    sample_num = min(n_frames, GIF_SAMPLE_FRAMES)
+    return [i * n_frames // sample_num for i in range(sample_num)]
 
-    # 没有超出最大大小，直接返回
-    nbytes = output.getbuffer().nbytes
-    if nbytes <= imagetools_config.imagetools_gif_max_size * 10**6:
-        return output
 
-    # 超出最大大小，帧数超出最大帧数时，缩减帧数
-    n_frames = len(frames)
+def estimate_gif_size(
+    sample: list[TimedFrame], n_frames: int, palette: Optional[GifPalette] = None
+) -> float:
+    """
+    通过编码少量采样帧预估gif大小
+    :params
+      * ``sample``: 采样帧和帧间隔
+      * ``n_frames``: gif总帧数
+      * ``palette``: 可选，gif 的全局调色板
+    """
+    nbytes = encode_animation(sample, palette).getbuffer().nbytes
+    return nbytes / len(sample) * n_frames
+
+
+def scale_size(size: tuple[int, int], scale: float) -> tuple[int, int]:
+    return (max(int(size[0] * scale), 1), max(int(size[1] * scale), 1))
+
+
+def resize_frames(frames: list[IMG], scale: float) -> list[IMG]:
+    if scale >= 1:
+        return frames
+    return [frame.resize(scale_size(frame.size, scale)) for frame in frames]
+
+
+class GifPlan(NamedTuple):
+    indexes: list[int]
+    """保留的帧索引"""
+    durations: list[float]
+    """保留的各帧的帧间隔，单位为秒"""
+    scale: float
+    """尺寸缩放比例"""
+
+
+def get_gif_max_frames() -> int:
+    """gif 的最大帧数，降级处理时使用更小的值"""
     gif_max_frames = imagetools_config.imagetools_gif_max_frames
+    if get_job_stats().degraded:
+        timeout_config = imagetools_config.imagetools_timeout_config
+        return min(gif_max_frames, timeout_config.degraded_max_frames)
+    return gif_max_frames
+
+
+def plan_gif(durations: list[float], estimated_size: float) -> GifPlan:
+    """
+    根据预估大小一次性确定要保留的帧和缩放比例
+    :params
+      * ``durations``: 各帧的帧间隔，单位为秒
+      * ``estimated_size``: 预估的gif大小，单位为字节
+    """
+    max_size = imagetools_config.imagetools_gif_max_size * 10**6
+    degraded = get_job_stats().degraded
+    n_frames = len(durations)
+    indexes = list(range(n_frames))
+    if estimated_size <= max_size and not degraded:
+        return GifPlan(indexes, durations, 1)
+
+    # 超出最大大小，帧数超出最大帧数时，缩减帧数
+    ratio = max_size * GIF_SIZE_MARGIN / estimated_size
+    gif_max_frames = get_gif_max_frames()
     if n_frames > gif_max_frames:
-        index = range(n_frames)
-        ratio = n_frames / gif_max_frames
-        index = (int(i * ratio) for i in range(gif_max_frames))
-        new_duration = duration * ratio
-        new_frames = [frames[i] for i in index]
-        return save_gif(new_frames, new_duration)
-
-    # 超出最大大小，帧数没有超出最大帧数时，缩小尺寸
-    new_frames = [
-        frame.resize((int(frame.width * 0.9), int(frame.height * 0.9)))
-        for frame in frames
-    ]
-    return save_gif(new_frames, duration)
+        step = n_frames / gif_max_frames
+        indexes = [int(i * step) for i in range(gif_max_frames)]
+        # 保留的帧显示到下一个保留的帧为止，总时长不变
+        durations = [
+            sum(durations[start:end])
+            for start, end in zip(indexes, indexes[1:] + [n_frames])
+        ]
+        ratio *= step
+
+    # 缩减帧数后仍超出最大大小时，缩小尺寸，gif大小近似与像素数成正比
+    scale = min(math.sqrt(ratio), 1)
+    if degraded:
+        scale = min(scale, imagetools_config.imagetools_timeout_config.degraded_scale)
+    return GifPlan(indexes, durations, scale)
+
+
+def plan_gif_from_sample(
+    sample: list[TimedFrame],
+    durations: list[float],
+    palette: Optional[GifPalette] = None,
+) -> GifPlan:
+    """
+    根据采样帧确定要保留的帧和缩放比例
+    :params
+      * ``sample``: 采样帧和帧间隔
+      * ``durations``: gif各帧的帧间隔，单位为秒
+      * ``palette``: 可选，gif 的全局调色板
+    """
+    plan = plan_gif(durations, estimate_gif_size(sample, len(durations), palette))
+    if plan.scale >= 1:
+        return plan
+
+    # gif大小与像素数并非严格成正比，用缩小后的采样帧再预估一次以修正缩放比例
+    max_size = imagetools_config.imagetools_gif_max_size * 10**6
+    frames = resize_frames([frame for frame, _ in sample], plan.scale)
+    estimated_size = estimate_gif_size(
+        list(zip(frames, (duration for _, duration in sample))),
+        len(plan.indexes),
+        palette,
+    )
+    scale = plan.scale * math.sqrt(max_size * GIF_SIZE_MARGIN / estimated_size)
+    # 降级处理时缩放比例不超过预先确定的值
+    max_scale = plan.scale if get_job_stats().degraded else 1
+    return plan._replace(scale=min(scale, max_scale))
+
+
+FrameSource = Callable[[float], Iterable[TimedFrame]]
+"""按照给定缩放比例依次生成帧和帧间隔"""
+
+
+def fit_gif(
+    make_frames: FrameSource, scale: float = 1, palette: Optional[GifPalette] = None
+) -> BytesIO:
+    """
+    按照给定缩放比例编码gif，结果仍超出最大大小时，根据实际大小修正缩放比例后重新生成帧并编码，
+    修正时预留较大的余量，最多只重新编码一次
+    :params
+      * ``make_frames``: 帧生成函数，输入缩放比例，返回帧和帧间隔序列
+      * ``scale``: 初始缩放比例
+      * ``palette``: 可选，gif 的全局调色板
+    """
+    stats = get_job_stats()
+    max_size = imagetools_config.imagetools_gif_max_size * 10**6
+    size = (0, 0)
+    n_frames = 0
+
+    def frames() -> Iterator[TimedFrame]:
+        nonlocal size, n_frames
+        n_frames = 0
+        for frame, duration in make_frames(scale):
+            size = frame.size
+            n_frames += 1
+            yield frame, duration
+
+    output = encode_animation(frames(), palette)
+    passes = 1
+    nbytes = output.getbuffer().nbytes
+    if nbytes > max_size and min(size) > 1:
+        scale *= math.sqrt(max_size * GIF_RETRY_MARGIN / nbytes)
+        output = encode_animation(frames(), palette)
+        passes += 1
+        nbytes = output.getbuffer().nbytes
+        if nbytes > max_size:
+            logger.warning(
+                f"gif still exceeds size limit after re-encoding: {nbytes} bytes"
+            )
+
+    stats.encode_passes += passes
+    stats.gif_shrunk = stats.gif_shrunk or scale < 1
+    logger.debug(
+        f"gif encoded in {passes} pass(es): {n_frames} frames, "
+        f"scale {scale:.3f}, {nbytes} bytes"
+    )
+    return output
+
+
+FrameLoader = Callable[[list[int]], Iterator[IMG]]
+"""按给定顺序依次读取帧"""
+
+
+def encode_frames(load_frames: FrameLoader, durations: list[float]) -> BytesIO:
+    """
+    逐帧读取并编码gif，内容相同的连续帧合并为一帧，
+    超出大小限制时，根据采样帧预估的大小一次性缩减帧数和尺寸
+    :params
+      * ``load_frames``: 帧读取函数，输入帧索引列表，依次返回对应的帧
+      * ``durations``: 各帧的帧间隔，单位为秒
+    """
+    n_frames = len(durations)
+    gif_max_frames = get_gif_max_frames()
+    degraded = get_job_stats().degraded
+    indexes = list(range(n_frames))
+    scale = 1
+    sample_idxs = sample_indexes(n_frames)
+    sample = list(zip(load_frames(sample_idxs), (durations[i] for i in sample_idxs)))
+    palette = sample_palette([frame for frame, _ in sample])
+    if n_frames > min(GIF_SAMPLE_FRAMES * 2, gif_max_frames) or degraded:
+        # 帧数较多或降级处理时，先根据采样帧预估大小并确定缩减方式，否则直接编码
+        plan = plan_gif_from_sample(sample, durations, palette)
+        if len(plan.indexes) < n_frames:
+            get_job_stats().gif_shrunk = True
+        indexes, durations, scale = plan
+
+    def make_frames(scale: float) -> Iterator[TimedFrame]:
+        frames = load_frames(indexes)
+        if scale < 1:
+            frames = (frame.resize(scale_size(frame.size, scale)) for frame in frames)
+        return merge_identical_frames(zip(frames, durations))
+
+    return fit_gif(make_frames, scale, palette)
+
+
+def save_gif(frames: list[IMG], duration: Union[float, list[float]]) -> BytesIO:
+    """
+    保存gif
+    :params
+      * ``frames``: 帧列表
+      * ``duration``: 帧间隔，单位为秒，也可以是各帧的帧间隔列表
+    """
+    durations: list[float] = (
+        duration if isinstance(duration, list) else [duration] * len(frames)
+    )
+    return encode_frames(lambda idxs: (frames[i] for i in idxs), durations)
+
+
+def save_gif_frames(
+    image: IMG, frame_idxs: list[int], duration: Union[float, list[float]]
+) -> BytesIO:
+    """
+    按给定顺序重新保存动图的帧，需要时才读取各帧，不预先读取所有帧
+    :params
+      * ``image``: 输入动图
+      * ``frame_idxs``: 输出的各帧在输入动图中的帧索引
+      * ``duration``: 帧间隔，单位为秒，也可以是各帧的帧间隔列表
+    """
+    durations: list[float] = (
+        duration if isinstance(duration, list) else [duration] * len(frame_idxs)
+    )
+    return encode_frames(
+        lambda idxs: read_frames(image, [frame_idxs[i] for i in idxs]), durations
+    )
+
+
+def read_frames(image: IMG, frame_idxs: list[int]) -> Iterator[IMG]:
+    """
+    按给定顺序读取动图的帧，gif 只能从前向后解码，
+    帧索引递增时逐帧读取，否则每次按索引从小到大读取一段并缓存，
+    缓存的帧数不超过内存预算，超出时需要多次从头解码
+    :params
+      * ``image``: 输入动图
+      * ``frame_idxs``: 要读取的帧索引
+    """
+    chunk_size = frame_budget(image.width * image.height * BYTES_PER_PIXEL)
+    for start in range(0, len(frame_idxs), chunk_size):
+        chunk = frame_idxs[start : start + chunk_size]
+        if chunk == sorted(chunk):
+            for i in chunk:
+                check_deadline()
+                image.seek(i)
+                yield image.copy()
+            continue
+        frames: dict[int, IMG] = {}
+        for i in sorted(set(chunk)):
+            check_deadline()
+            image.seek(i)
+            frames[i] = image.copy()
+        for i in chunk:
+            yield frames[i]
+        del frames
+
+
+def draft_image(img: BuildImage, size: tuple[int, int]):
+    """
+    jpeg 图片尚未解码时，以不小于给定尺寸的最大缩小比例解码，其他图片不受影响
+    """
+    if min(size) >= 1:
+        img.image.draft(None, size)
+
+
+def filter_image(img: BuildImage, image_filter: type[Filter]) -> BuildImage:
+    """
+    对图片应用卷积核滤镜，像素数较多时将图片分为互相重叠的横条并行处理后拼接，
+    重叠的行数等于卷积核半径，结果与整体处理一致
+    :params
+      * ``img``: 输入图片
+      * ``image_filter``: 滤镜，如 ``ImageFilter.BLUR``
+    """
+    image = img.image
+    parallel_config = imagetools_config.imagetools_parallel_config
+    kernel_size: Optional[tuple[int, int]] = getattr(
+        image_filter, "filterargs", (None,)
+    )[0]
+    # 分块只在有多个 cpu 核心时有收益
+    n_tiles = min(parallel_config.threads, os.cpu_count() or 1, image.height)
+    if (
+        kernel_size is None
+        or n_tiles <= 1
+        or image.mode == "P"
+        or image.width * image.height < parallel_config.tile_min_pixels
+    ):
+        return img.filter(image_filter)
+
+    radius = kernel_size[1] // 2
+    w, h = image.size
+    bounds = [h * i // n_tiles for i in range(n_tiles + 1)]
+    # 在当前线程中解码，各线程只读取像素
+    image.load()
+
+    def filter_tile(i: int) -> IMG:
+        top, bottom = bounds[i], bounds[i + 1]
+        extended_top = max(top - radius, 0)
+        extended_bottom = min(bottom + radius, h)
+        tile = image.crop((0, extended_top, w, extended_bottom)).filter(image_filter)
+        return tile.crop((0, top - extended_top, w, bottom - extended_top))
+
+    output = Image.new(image.mode, image.size)
+    output.info = image.info.copy()
+    for i, tile in enumerate(parallel_map(filter_tile, range(n_tiles), n_tiles)):
+        output.paste(tile, (0, bounds[i]))
+    return BuildImage(output)
+
+
+def get_n_frames(image: IMG) -> int:
+    if meta := get_image_meta(image):
+        return meta.n_frames
+    return getattr(image, "n_frames", 1)
 
 
 def get_avg_duration(image: IMG) -> float:
     if not getattr(image, "is_animated", False):
         return 0
+    if meta := get_image_meta(image):
+        return meta.avg_duration
     total_duration = 0
     n_frames = getattr(image, "n_frames", 1)
     for i in range(n_frames):
@@ -61,6 +558,7 @@ def split_gif(image: IMG) -> list[IMG]:
     frames: list[IMG] = []
     n_frames = getattr(image, "n_frames", 1)
     for i in range(n_frames):
+        check_deadline()
         image.seek(i)
         frame = image.copy()
         frames.append(frame)
@@ -85,6 +583,56 @@ class FrameAlignPolicy(Enum):
     """以循环方式延长"""
 
 
+def get_loop_num(
+    gif_infos: list[tuple[int, float]], frame_num_target: int, duration_target: float
+) -> int:
+    """
+    以循环方式延长时目标gif的重复次数，
+    重复到每个gif总时长之差在1个间隔以内，或总帧数超出最大帧数为止
+    """
+    max_frames = imagetools_config.imagetools_gif_max_frames
+    loop_num = 1
+    while (loop_num + 1) * frame_num_target <= max_frames:
+        loop_num += 1
+        total_duration = loop_num * frame_num_target * duration_target
+        if all(
+            math.fabs(
+                round(total_duration / duration / frame_num) * duration * frame_num
+                - total_duration
+            )
+            <= duration_target
+            for frame_num, duration in gif_infos
+        ):
+            break
+    return loop_num
+
+
+def get_frame_indexes(
+    frame_num: int, duration: float, frame_num_target: int, duration_target: float
+) -> list[int]:
+    """
+    目标gif每一帧的开始时间对应的输入gif帧索引，超出输入gif总时长时循环
+    """
+    total_duration = frame_num * duration
+    time_start = 0
+    frame_idxs: list[int] = []
+    for i in range(frame_num_target):
+        time = i * duration_target - time_start
+        while time >= total_duration:
+            time_start += total_duration
+            time = i * duration_target - time_start
+        frame_idx = int(time / duration)
+        if not frame_idx * duration <= time < (frame_idx + 1) * duration:
+            # 除法的结果可能因浮点误差与按帧区间比较的结果相差一帧
+            frame_idx = min(max(frame_idx, 0), frame_num - 1)
+            while frame_idx > 0 and frame_idx * duration > time:
+                frame_idx -= 1
+            while (frame_idx + 1) * duration <= time:
+                frame_idx += 1
+        frame_idxs.append(frame_idx)
+    return frame_idxs
+
+
 def get_aligned_gif_indexes(
     gif_infos: list[tuple[int, float]],
     frame_num_target: int,
@@ -120,130 +668,230 @@ def get_aligned_gif_indexes(
             frame_idxs_target += [frame_num_target - 1] * diff_num
 
         elif frame_align == FrameAlignPolicy.extend_loop:
-            frame_num_total = frame_num_target
-            # 重复目标gif，直到每个gif总时长之差在1个间隔以内，或总帧数超出最大帧数
-            while (
-                frame_num_total + frame_num_target
-                <= imagetools_config.imagetools_gif_max_frames
-            ):
-                frame_num_total += frame_num_target
-                frame_idxs_target += list(range(frame_num_target))
-                total_duration = frame_num_total * duration_target
-                if all(
-                    math.fabs(
-                        round(total_duration / duration / frame_num)
-                        * duration
-                        * frame_num
-                        - total_duration
-                    )
-                    <= duration_target
-                    for frame_num, duration in gif_infos
-                ):
-                    break
-
-    frame_idxs_input: list[list[int]] = []
-    for frame_num, duration in gif_infos:
-        frame_idx = 0
-        time_start = 0
-        frame_idxs: list[int] = []
-        for i in range(len(frame_idxs_target)):
-            while frame_idx < frame_num:
-                if (
-                    frame_idx * duration
-                    <= i * duration_target - time_start
-                    < (frame_idx + 1) * duration
-                ):
-                    frame_idxs.append(frame_idx)
-                    break
-                else:
-                    frame_idx += 1
-                    if frame_idx >= frame_num:
-                        frame_idx = 0
-                        time_start += frame_num * duration
-        frame_idxs_input.append(frame_idxs)
+            frame_idxs_target *= get_loop_num(
+                gif_infos, frame_num_target, duration_target
+            )
 
+    frame_idxs_input = [
+        get_frame_indexes(frame_num, duration, len(frame_idxs_target), duration_target)
+        for frame_num, duration in gif_infos
+    ]
     return frame_idxs_input, frame_idxs_target
 
 
 Maker = Callable[[list[BuildImage]], BuildImage]
 
-
-def merge_gif(imgs: list[BuildImage], func: Maker) -> BytesIO:
+FramePreparer = Callable[[list[BuildImage], list[bool]], Maker]
+"""
+输入各图片的第一帧和每张图片是否为动图，预先处理不随帧变化的部分，返回每帧使用的处理函数
+"""
+
+
+def get_maker(
+    imgs: list[BuildImage],
+    animated: list[bool],
+    func: Optional[Maker],
+    prepare: Optional[FramePreparer],
+) -> Maker:
+    if prepare:
+        return prepare(imgs, animated)
+    assert func, "either func or prepare should be provided"
+    return func
+
+
+def merge_gif(
+    imgs: list[BuildImage],
+    func: Optional[Maker] = None,
+    prepare: Optional[FramePreparer] = None,
+) -> BytesIO:
     """
     合并动图
     :params
       * ``imgs``: 输入图片列表
       * ``func``: 图片处理函数，输入imgs，返回处理后的图片
+      * ``prepare``: 可选，代替 ``func`` 预先处理静图等不随帧变化的部分
     """
     images = [img.image for img in imgs]
+    animated = [getattr(image, "is_animated", False) for image in images]
     gif_images = [image for image in images if getattr(image, "is_animated", False)]
 
     if len(gif_images) == 1:
-        frames: list[IMG] = []
-        frame_num = getattr(gif_images[0], "n_frames", 1)
+        frame_num = get_n_frames(gif_images[0])
         duration = get_avg_duration(gif_images[0])
-        for i in range(frame_num):
-            frame_images: list[IMG] = []
-            for image in images:
-                if getattr(image, "is_animated", False):
-                    image.seek(i)
-                frame_images.append(image.copy())
-            frame = func([BuildImage(image) for image in frame_images])
-            frames.append(frame.image)
-        return save_gif(frames, duration)
-
-    gif_infos = [
-        (getattr(image, "n_frames", 1), get_avg_duration(image)) for image in gif_images
-    ]
-    target_duration = min(duration for _, duration in gif_infos)
-    target_gif_idx = [
-        i for i, (_, duration) in enumerate(gif_infos) if duration == target_duration
-    ][0]
-    target_frame_num = gif_infos[target_gif_idx][0]
-    gif_infos.pop(target_gif_idx)
-    frame_idxs, target_frame_idxs = get_aligned_gif_indexes(
-        gif_infos, target_frame_num, target_duration, FrameAlignPolicy.extend_loop
+        frame_idxs = [list(range(frame_num))]
+    else:
+        gif_infos = [
+            (get_n_frames(image), get_avg_duration(image)) for image in gif_images
+        ]
+        target_duration = min(duration for _, duration in gif_infos)
+        target_gif_idx = [
+            i
+            for i, (_, duration) in enumerate(gif_infos)
+            if duration == target_duration
+        ][0]
+        target_frame_num = gif_infos[target_gif_idx][0]
+        gif_infos.pop(target_gif_idx)
+        frame_idxs, target_frame_idxs = get_aligned_gif_indexes(
+            gif_infos, target_frame_num, target_duration, FrameAlignPolicy.extend_loop
+        )
+        frame_idxs.insert(target_gif_idx, target_frame_idxs)
+        duration = target_duration
+
+    # 静图和处理函数只在每种缩放比例下准备一次，各帧共用
+    static_images: dict[float, list[Optional[BuildImage]]] = {}
+    makers: dict[float, Maker] = {}
+    frame_pixels = sum(image.width * image.height for image in images)
+
+    def load_frame(i: int) -> list[IMG]:
+        # 输入图片的 seek 不是线程安全的，在调用方的线程中依次读取
+        check_deadline()
+        frames: list[IMG] = []
+        for image, idxs in zip(gif_images, frame_idxs):
+            image.seek(idxs[i])
+            frames.append(image.copy())
+        return frames
+
+    def get_frame_images(frames: list[IMG], scale: float) -> list[BuildImage]:
+        resized = iter(resize_frames(frames, scale))
+        return [
+            BuildImage(next(resized)) if static_image is None else static_image
+            for static_image in static_images[scale]
+        ]
+
+    def load_frames(idxs: list[int]) -> Iterator[Optional[list[IMG]]]:
+        """依次读取给定的帧，各输入帧都与上一帧内容相同时返回 ``None``"""
+        last_idxs: list[int] = []
+        last_keys: list[FrameKey] = []
+        for i in idxs:
+            source_idxs = [gif_idxs[i] for gif_idxs in frame_idxs]
+            # 对齐多个 gif 时，帧间隔较长的 gif 会重复使用同一源帧，不需要重新读取
+            if source_idxs == last_idxs:
+                yield None
+                continue
+            frames = load_frame(i)
+            keys = [
+                last_keys[j]
+                if last_idxs and last_idxs[j] == source_idxs[j]
+                else FrameKey(frame)
+                for j, frame in enumerate(frames)
+            ]
+            yield None if keys == last_keys else frames
+            last_idxs, last_keys = source_idxs, keys
+
+    def make_frame(frames: Optional[list[IMG]], scale: float) -> Optional[IMG]:
+        if frames is None:
+            return None
+        return makers[scale](get_frame_images(frames, scale)).image
+
+    def process_frames(idxs: list[int], scale: float = 1) -> Iterator[IMG]:
+        """
+        依次处理给定的帧，处理函数可以并行时在线程池中同时处理多帧，
+        输入与上一帧相同的帧不再处理，直接复用上一帧的处理结果
+        """
+        if not idxs:
+            return
+        if scale not in makers:
+            static_images[scale] = [
+                None if is_animated else BuildImage(resize_frames([image], scale)[0])
+                for image, is_animated in zip(images, animated)
+            ]
+            makers[scale] = get_maker(
+                get_frame_images(load_frame(idxs[0]), scale), animated, func, prepare
+            )
+        frames = load_frames(idxs)
+        process = partial(make_frame, scale=scale)
+        if get_job_stats().parallel:
+            # 输入帧和处理结果各占一份内存
+            frame_bytes = int(frame_pixels * scale**2 * BYTES_PER_PIXEL * 2)
+            outputs = parallel_map(process, frames, frame_window(frame_bytes))
+        else:
+            outputs = map(process, frames)
+        last: Optional[IMG] = None
+        for output in outputs:
+            if output is not None:
+                last = output
+            assert last is not None
+            yield last
+
+    n_frames = len(frame_idxs[0])
+    if n_frames <= GIF_SAMPLE_FRAMES * 2 and not get_job_stats().degraded:
+        return save_gif(list(process_frames(list(range(n_frames)))), duration)
+
+    # 先处理少量采样帧预估输出大小，确定要保留的帧和尺寸后，只处理需要保留的帧
+    sample_idxs = sample_indexes(n_frames)
+    sample = list(process_frames(sample_idxs))
+    palette = sample_palette(sample)
+    plan = plan_gif_from_sample(
+        [(frame, duration) for frame in sample], [duration] * n_frames, palette
     )
-    frame_idxs.insert(target_gif_idx, target_frame_idxs)
-
-    frames: list[IMG] = []
-    for i in range(len(target_frame_idxs)):
-        frame_images: list[IMG] = []
-        gif_idx = 0
-        for image in images:
-            if getattr(image, "is_animated", False):
-                image.seek(frame_idxs[gif_idx][i])
-                gif_idx += 1
-            frame_images.append(image.copy())
-        frame = func([BuildImage(image) for image in frame_images])
-        frames.append(frame.image)
-
-    return save_gif(frames, target_duration)
-
-
-def make_jpg_or_gif(imgs: list[BuildImage], func: Maker) -> BytesIO:
+    if len(plan.indexes) < n_frames:
+        get_job_stats().gif_shrunk = True
+
+    def full_size_frames() -> Iterator[IMG]:
+        processed = dict(zip(sample_idxs, sample))
+        frames = process_frames([i for i in plan.indexes if i not in processed])
+        for i in plan.indexes:
+            yield processed[i] if i in processed else next(frames)
+
+    def processed_frames(scale: float) -> Iterator[IMG]:
+        if scale >= 1:
+            yield from full_size_frames()
+            return
+
+        # 处理结果与输入尺寸成比例时，输入帧按比例缩小后再处理，
+        # 否则按原尺寸处理后缩小处理结果
+        if get_job_stats().scalable:
+            frames = process_frames(plan.indexes, scale)
+        else:
+            frames = full_size_frames()
+        size = scale_size(sample[0].size, scale)
+        for frame in frames:
+            yield frame if frame.size == size else frame.resize(size)
+
+    def make_frames(scale: float) -> Iterator[TimedFrame]:
+        # 处理结果内容相同的连续帧合并为一帧
+        return merge_identical_frames(zip(processed_frames(scale), plan.durations))
+
+    return fit_gif(make_frames, plan.scale, palette)
+
+
+def make_jpg_or_gif(
+    imgs: list[BuildImage],
+    func: Optional[Maker] = None,
+    prepare: Optional[FramePreparer] = None,
+) -> BytesIO:
     """
     制作静图或者动图
     :params
       * ``imgs``: 输入图片列表
       * ``func``: 图片处理函数，输入imgs，返回处理后的图片
+      * ``prepare``: 可选，代替 ``func`` 预先处理静图等不随帧变化的部分
     """
-    images = [img.image for img in imgs]
-    if all(not getattr(image, "is_animated", False) for image in images):
-        return func(imgs).save_jpg()
+    animated = [getattr(img.image, "is_animated", False) for img in imgs]
+    if not any(animated):
+        img = get_maker(imgs, animated, func, prepare)(imgs)
+        with record_encode():
+            return img.save_jpg()
 
-    return merge_gif(imgs, func)
+    return merge_gif(imgs, func, prepare)
 
 
-def make_png_or_gif(imgs: list[BuildImage], func: Maker) -> BytesIO:
+def make_png_or_gif(
+    imgs: list[BuildImage],
+    func: Optional[Maker] = None,
+    prepare: Optional[FramePreparer] = None,
+) -> BytesIO:
     """
     制作静图或者动图
     :params
       * ``imgs``: 输入图片列表
       * ``func``: 图片处理函数，输入imgs，返回处理后的图片
+      * ``prepare``: 可选，代替 ``func`` 预先处理静图等不随帧变化的部分
     """
-    images = [img.image for img in imgs]
-    if all(not getattr(image, "is_animated", False) for image in images):
-        return func(imgs).save_png()
+    animated = [getattr(img.image, "is_animated", False) for img in imgs]
+    if not any(animated):
+        img = get_maker(imgs, animated, func, prepare)(imgs)
+        with record_encode():
+            return img.save_png()
 
-    return merge_gif(imgs, func)
+    return merge_gif(imgs, func, prepare)
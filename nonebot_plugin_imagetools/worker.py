@@ -0,0 +1,60 @@
+from io import BytesIO
+from typing import Any, Callable, Optional
+
+from pil_utils import BuildImage, Text2Image
+
+from .job import JobStats, new_job_stats
+
+_worker_config: Optional[dict[str, Any]] = None
+
+
+def get_worker_config() -> Optional[dict[str, Any]]:
+    """主进程传入子进程的插件配置，不在子进程中时返回 ``None``"""
+    return _worker_config
+
+
+def init_worker(config: dict[str, Any]):
+    """
+    保存主进程的插件配置，由 ``nonebot_plugin_imagetools_worker.init_worker`` 调用
+    :params
+      * ``config``: 插件配置
+    """
+    global _worker_config
+    _worker_config = config
+
+
+def warm_up():
+    """在子进程中预先加载 Pillow 和 pil_utils 字体"""
+    Text2Image.from_text("图片操作", 30).to_image()
+
+
+def _decode_arg(value: Any) -> Any:
+    if isinstance(value, bytes):
+        return BuildImage.open(BytesIO(value))
+    if isinstance(value, list):
+        return [_decode_arg(v) for v in value]
+    return value
+
+
+def run_in_worker(
+    func: Callable,
+    args: dict[str, Any],
+    timeout: Optional[float],
+    degraded: bool,
+    parallel: bool,
+    animated_format: str,
+    scalable: bool,
+) -> tuple[Any, JobStats]:
+    """
+    在子进程中执行图片处理函数
+    :params
+      * ``func``: 图片处理函数
+      * ``args``: 参数，图片以原始字节传入
+      * ``timeout``: 剩余的处理时间，单位为秒
+    :return
+      * 处理结果和统计信息
+    """
+    # 不同进程的 monotonic 时间不一定可比，以剩余时间传入
+    stats = new_job_stats(timeout, degraded, parallel, animated_format, scalable)
+    result = func(**{key: _decode_arg(value) for key, value in args.items()})
+    return result, stats
@@ -0,0 +1,27 @@
+"""
+nonebot_plugin_imagetools 进程池子进程的入口，导入本模块不会加载插件
+"""
+
+import importlib
+import importlib.util
+import sys
+from typing import Any
+
+PACKAGE = "nonebot_plugin_imagetools"
+
+
+def init_worker(config: dict[str, Any]):
+    """
+    子进程的初始化函数，在反序列化任务之前执行
+    只注册插件包本身而不执行包的 ``__init__``，
+    之后导入的图片处理模块不会加载插件、不初始化 nonebot
+    :params
+      * ``config``: 主进程的插件配置
+    """
+    if PACKAGE not in sys.modules:
+        spec = importlib.util.find_spec(PACKAGE)
+        if spec is None:
+            raise ImportError(f"No module named {PACKAGE!r}")
+        sys.modules[PACKAGE] = importlib.util.module_from_spec(spec)
+    worker = importlib.import_module(f"{PACKAGE}.worker")
+    worker.init_worker(config)
@@ -0,0 +1,4 @@
+import nonebot
+
+nonebot.init(driver="~none")
+nonebot.load_plugin("nonebot_plugin_imagetools")
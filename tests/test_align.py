@@ -0,0 +1,137 @@
+"""
+以随机生成的输入对比 ``get_aligned_gif_indexes`` 与直接计算帧索引之前的逐帧扫描实现，
+两者的结果应当完全一致
+"""
+
+import math
+import random
+
+import pytest
+
+from nonebot_plugin_imagetools.config import imagetools_config
+from nonebot_plugin_imagetools.utils import FrameAlignPolicy, get_aligned_gif_indexes
+
+SEED = 20240601
+CASES = 300
+
+
+def get_aligned_gif_indexes_scan(
+    gif_infos: list[tuple[int, float]],
+    frame_num_target: int,
+    duration_target: float,
+    frame_align: FrameAlignPolicy = FrameAlignPolicy.no_extend,
+) -> tuple[list[list[int]], list[int]]:
+    """
+    逐帧扫描的原实现，作为对照保留，不要修改
+    将gif按照目标帧数和帧间隔对齐
+    :params
+        * ``gif_infos``: 每个输入gif的帧数和帧间隔，帧间隔单位为秒
+        * ``frame_num_target``: 目标gif的帧数
+        * ``duration_target``: 目标gif的帧间隔，单位为秒
+        * ``frame_align``: 要对齐的gif长度大于目标gif时，gif长度对齐方式
+    :return
+        * 输入gif的帧索引列表和目标gif的帧索引列表
+    """
+
+    frame_idxs_target: list[int] = list(range(frame_num_target))
+
+    max_total_duration_input = max(
+        frame_num * duration for frame_num, duration in gif_infos
+    )
+    total_duration_target = frame_num_target * duration_target
+    if (
+        diff_duration := max_total_duration_input - total_duration_target
+    ) >= duration_target:
+        diff_num = math.ceil(diff_duration / duration_target)
+
+        if frame_align == FrameAlignPolicy.extend_first:
+            frame_idxs_target = [0] * diff_num + frame_idxs_target
+
+        elif frame_align == FrameAlignPolicy.extend_last:
+            frame_idxs_target += [frame_num_target - 1] * diff_num
+
+        elif frame_align == FrameAlignPolicy.extend_loop:
+            frame_num_total = frame_num_target
+            # 重复目标gif，直到每个gif总时长之差在1个间隔以内，或总帧数超出最大帧数
+            while (
+                frame_num_total + frame_num_target
+                <= imagetools_config.imagetools_gif_max_frames
+            ):
+                frame_num_total += frame_num_target
+                frame_idxs_target += list(range(frame_num_target))
+                total_duration = frame_num_total * duration_target
+                if all(
+                    math.fabs(
+                        round(total_duration / duration / frame_num)
+                        * duration
+                        * frame_num
+                        - total_duration
+                    )
+                    <= duration_target
+                    for frame_num, duration in gif_infos
+                ):
+                    break
+
+    frame_idxs_input: list[list[int]] = []
+    for frame_num, duration in gif_infos:
+        frame_idx = 0
+        time_start = 0
+        frame_idxs: list[int] = []
+        for i in range(len(frame_idxs_target)):
+            while frame_idx < frame_num:
+                if (
+                    frame_idx * duration
+                    <= i * duration_target - time_start
+                    < (frame_idx + 1) * duration
+                ):
+                    frame_idxs.append(frame_idx)
+                    break
+                else:
+                    frame_idx += 1
+                    if frame_idx >= frame_num:
+                        frame_idx = 0
+                        time_start += frame_num * duration
+        frame_idxs_input.append(frame_idxs)
+
+    return frame_idxs_input, frame_idxs_target
+
+
+def random_duration(rng: random.Random) -> float:
+    # 大多数 gif 的帧间隔为整数毫秒，也包含不能精确表示为二进制小数的值
+    if rng.random() < 0.8:
+        return rng.randint(10, 200) / 1000
+    return rng.uniform(0.01, 0.2)
+
+
+def random_case(
+    rng: random.Random,
+) -> tuple[list[tuple[int, float]], int, float]:
+    gif_infos = [
+        (rng.randint(1, 60), random_duration(rng)) for _ in range(rng.randint(1, 4))
+    ]
+    return gif_infos, rng.randint(1, 60), random_duration(rng)
+
+
+FIXED_CASES: list[tuple[list[tuple[int, float]], int, float]] = [
+    ([(1, 0.1)], 1, 0.1),
+    ([(10, 0.1)], 10, 0.1),
+    ([(30, 0.03)], 10, 0.1),
+    ([(7, 0.07), (3, 0.3)], 5, 0.02),
+    ([(60, 0.2)], 1, 0.01),
+    ([(1, 0.01)], 60, 0.2),
+]
+
+
+@pytest.mark.parametrize("max_frames", [1, 10, 50, 100, 500])
+@pytest.mark.parametrize("frame_align", list(FrameAlignPolicy))
+def test_aligned_gif_indexes(
+    monkeypatch: pytest.MonkeyPatch, frame_align: FrameAlignPolicy, max_frames: int
+):
+    monkeypatch.setattr(imagetools_config, "imagetools_gif_max_frames", max_frames)
+    rng = random.Random(f"{SEED}-{frame_align.name}-{max_frames}")
+    cases = FIXED_CASES + [random_case(rng) for _ in range(CASES)]
+    for gif_infos, frame_num_target, duration_target in cases:
+        args = (gif_infos, frame_num_target, duration_target, frame_align)
+        assert get_aligned_gif_indexes(*args) == get_aligned_gif_indexes_scan(*args), (
+            args
+        )
@@ -0,0 +1,48 @@
+"""
+``parse_color`` 对原先支持的颜色格式的解析结果应保持不变，超出范围的颜色应无法解析
+"""
+
+import pytest
+
+from nonebot_plugin_imagetools.color import parse_color
+
+
+@pytest.mark.parametrize(
+    ("text", "color"),
+    [
+        ("#66ccff", (102, 204, 255)),
+        ("#66CCFF", (102, 204, 255)),
+        ("#6cf", (102, 204, 255)),
+        ("#66ccff80", (102, 204, 255, 128)),
+        ("red", (255, 0, 0)),
+        ("Red", (255, 0, 0)),
+        ("红色", (255, 0, 0)),
+        ("102,204,255", (102, 204, 255)),
+        ("102 204 255", (102, 204, 255)),
+        ("rgb(102,204,255)", (102, 204, 255)),
+        ("(102, 204, 255);", (102, 204, 255)),
+        ("hsl(0,100%,50%)", (255, 0, 0)),
+        ("hsl(200,100%,70%)", (102, 204, 255)),
+        ("hsl(120, 100.0%, 25.5%)", (0, 130, 0)),
+    ],
+)
+def test_parse_color(text: str, color: tuple[int, ...]):
+    assert parse_color(text) == color
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "#66ccf",
+        "#ggg",
+        "256,0,0",
+        "not a color",
+        "hsl(0,500%,50%)",
+        "hsl(0,50%,101%)",
+        "hsl(0,100.5%,50%)",
+        "hsl(0,-10%,50%)",
+    ],
+)
+def test_parse_color_invalid(text: str):
+    assert parse_color(text) is None